@@ -1,4 +1,10 @@
-from .base import Feature, get_features, generate_features
+from .base import Feature, IncrementalFeature, get_features, generate_features, append_features
 from .create import create_features
+from .loader import FeatureMatrix, load_features, load_feature_matrix, make_feature_matrix
+from .store import FeatureStore
 
-__all__ = ['Feature', 'get_features', 'generate_features', 'create_features']
+__all__ = [
+    'Feature', 'IncrementalFeature', 'get_features', 'generate_features', 'append_features',
+    'create_features', 'load_features', 'load_feature_matrix', 'make_feature_matrix', 'FeatureMatrix',
+    'FeatureStore',
+]
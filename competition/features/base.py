@@ -2,28 +2,61 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import hashlib
 import inspect
+import json
 import re
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 from contextlib import contextmanager
 import time
+from datetime import datetime
 
 import pandas as pd
 import numpy as np
+import yaml
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from utils.data_utils import read_compact_schema, restore_dtypes, write_compact_feather, write_compact_parquet
+from utils.encoding import CategoricalEncoder, extract_title
+from utils.logger import setup_logger
+
+# use_loggerで設定した場合、メッセージをprintではなくこのロガーに出力する
+_logger = None
+
+
+def use_logger(enabled=True, json_format=None):
+    """特徴量生成のメッセージをキュー経由のロガー（utils.logger）に出力する"""
+    global _logger
+    _logger = setup_logger('features', json_format=json_format) if enabled else None
+
+
+def _echo(message):
+    if _logger is None:
+        print(message)
+    else:
+        _logger.info(message)
 
 
 @contextmanager
 def timer(name):
-    t0 = time.time()
-    print(f'[{name}] start')
+    t0 = time.perf_counter()
+    _echo(f'[{name}] start')
     yield
-    print(f'[{name}] done in {time.time() - t0:.0f} s')
+    _echo(f'[{name}] done in {time.perf_counter() - t0:.3f} s')
 
 
 def get_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('--force', '-f', action='store_true')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='特徴量生成の並列プロセス数')
+    parser.add_argument('--append', type=str, default=None,
+                        help='新しい行のCSV（IncrementalFeatureだけを変換して既存ファイルに追記する）')
+    parser.add_argument('--split', type=str, default='test', choices=['train', 'test'], help='--appendの追記先')
+    parser.add_argument('--log', action='store_true', help='printの代わりにロガー（キュー経由）で出力する')
     return parser.parse_args()
 
 
@@ -33,108 +66,459 @@ def get_features(namespace):
             yield v()
 
 
-def generate_features(namespace, overwrite=False):
-    for feature in get_features(namespace):
-        if feature.train_path.exists() and feature.test_path.exists() and not overwrite:
-            print(f'{feature.name} was skipped')
+def _sort_features(features):
+    """依存関係に従って特徴量名をトポロジカル順に並べる"""
+    order = []
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError(f'circular feature dependency: {" -> ".join(path + [name])}')
+        state[name] = 'visiting'
+        for dep in features[name].depends:
+            if dep not in features:
+                raise ValueError(f'{name} depends on unknown feature {dep}')
+            visit(dep, path + [name])
+        state[name] = 'done'
+        order.append(name)
+
+    for name in features:
+        visit(name, [])
+    return order
+
+
+def _run_feature(feature_class):
+    """特徴量を1つ生成して保存する（ワーカープロセスからも呼ばれる）"""
+    feature = feature_class()
+    t0 = time.perf_counter()
+    feature.run().save()
+    return feature.name, time.perf_counter() - t0, feature.describe()
+
+
+def _run_parallel(features, pending, n_jobs, on_done):
+    """依存関係を満たした特徴量から順にプロセスプールで実行する"""
+    elapsed = {}
+    waiting = {name: {dep for dep in features[name].depends if dep in pending} for name in pending}
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        while waiting or running:
+            for name in [name for name, deps in waiting.items() if not deps]:
+                del waiting[name]
+                running[executor.submit(_run_feature, type(features[name]))] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, elapsed[name], entry = future.result()
+                del running[future]
+                on_done(name, entry)
+                for deps in waiting.values():
+                    deps.discard(name)
+    return elapsed
+
+
+def _report(features, order, elapsed):
+    """特徴量ごとの実行時間とクリティカルパス時間を表示"""
+    finish = {}
+    for name in order:
+        start = max((finish[dep] for dep in features[name].depends), default=0.0)
+        finish[name] = start + elapsed.get(name, 0.0)
+    _echo('[generate_features] wall time per feature')
+    for name in order:
+        _echo(f'  {name}: {elapsed.get(name, 0.0):.2f} s')
+    _echo(f'[generate_features] total {sum(elapsed.values()):.2f} s, '
+          f'critical path {max(finish.values(), default=0.0):.2f} s')
+
+
+def _hash_file(path, file_hashes):
+    """入力ファイルの内容ハッシュ（同一実行内ではパスごとに1回だけ計算）"""
+    path = str(path)
+    if path not in file_hashes:
+        if not Path(path).exists():
+            file_hashes[path] = 'missing'
         else:
-            feature.run().save()
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            file_hashes[path] = h.hexdigest()
+    return file_hashes[path]
+
+
+def _load_manifest(path):
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_manifest(path, manifest):
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    tmp_path.replace(path)
+
+
+def generate_features(namespace, overwrite=False, n_jobs=1):
+    """キャッシュキーが変わった特徴量だけを生成する
+
+    キャッシュキーはクラスのソース・入力ファイル・パラメータ・依存特徴量のキーから
+    計算し、特徴量ディレクトリのマニフェストに記録する。overwrite=Trueで全て再生成する。
+    生成した特徴量は特徴量ディレクトリのカタログ（FeatureStore）に登録する。
+    """
+    from .store import FeatureStore
+
+    features = {feature.name: feature for feature in get_features(namespace)}
+    if not features:
+        _echo('no Feature subclasses found in the namespace')
+    order = _sort_features(features)
+
+    keys = {}
+    file_hashes = {}
+    manifests = {}
+    pending = []
+    for name in order:
+        feature = features[name]
+        keys[name] = feature.cache_key([keys[dep] for dep in feature.depends], file_hashes)
+        if feature.manifest_path not in manifests:
+            manifests[feature.manifest_path] = _load_manifest(feature.manifest_path)
+        cached = manifests[feature.manifest_path].get(name) == keys[name]
+        if feature.train_path.exists() and feature.test_path.exists() and cached and not overwrite:
+            _echo(f'{name} was skipped')
+        else:
+            pending.append(name)
+
+    stores = {}
+
+    def on_done(name, entry):
+        manifest_path = features[name].manifest_path
+        manifests[manifest_path][name] = keys[name]
+        _save_manifest(manifest_path, manifests[manifest_path])
+        feature_dir = features[name].dir
+        if feature_dir not in stores:
+            stores[feature_dir] = FeatureStore(feature_dir)
+        stores[feature_dir].register({**entry, 'cache_key': keys[name]})
+
+    if n_jobs > 1 and len(pending) > 1:
+        elapsed = _run_parallel(features, set(pending), n_jobs, on_done)
+    else:
+        elapsed = {}
+        for name in pending:
+            _, elapsed[name], entry = _run_feature(type(features[name]))
+            on_done(name, entry)
+
+    _report(features, order, elapsed)
+    return elapsed
+
+
+def append_features(namespace, new_rows, split='test'):
+    """IncrementalFeatureだけを依存関係順に実行し、新しい行を既存の特徴量に追記する
+
+    追記した特徴量に（間接的に）依存する通常の特徴量は行数が古いままになるため、
+    マニフェストのキャッシュキーを消してgenerate_featuresで再生成する。
+
+    Returns:
+        dict: 特徴量名→追記した行数
+    """
+    features = {feature.name: feature for feature in get_features(namespace)}
+    order = _sort_features(features)
+    appended = {}
+    for name in order:
+        feature = features[name]
+        if not isinstance(feature, IncrementalFeature):
+            continue
+        with timer(f'{name} append'):
+            appended[name] = feature.append(new_rows, split)
+        _echo(f'{name}: appended {appended[name]} rows to {split}')
+    if not appended:
+        _echo('no IncrementalFeature subclasses found in the namespace, nothing was appended')
+
+    changed = {name for name, n_rows in appended.items() if n_rows}
+    stale = []
+    for name in order:
+        if name not in changed and any(dep in changed for dep in features[name].depends):
+            changed.add(name)
+            stale.append(name)
+    if stale:
+        for name in stale:
+            manifest_path = features[name].manifest_path
+            manifest = _load_manifest(manifest_path)
+            manifest.pop(name, None)
+            _save_manifest(manifest_path, manifest)
+        _echo(f'rebuilding features that depend on appended ones: {stale}')
+        generate_features(namespace)
+    return appended
+
+
+def split_files(path):
+    """特徴量ファイルと、appendで追記したパート（`{stem}.part-NNNNN{suffix}`）をパート順に返す"""
+    path = Path(path)
+    return [path] + sorted(path.parent.glob(f'{path.stem}.part-*{path.suffix}'))
+
+
+def read_feature_table(path, columns=None):
+    """特徴量ファイルと追記したパートをメモリマップし、1つのArrowテーブルとして読み込む
+
+    パートごとに縮小した型が異なる場合は表現できる型に揃える。
+    """
+    tables = []
+    for part in split_files(path):
+        if part.suffix == '.parquet':
+            tables.append(pq.read_table(str(part), columns=columns, memory_map=True))
+        else:
+            tables.append(feather.read_table(str(part), columns=columns, memory_map=True))
+    if len(tables) == 1:
+        return tables[0]
+    return pa.concat_tables(tables, promote_options='permissive')
 
 
 class Feature(metaclass=ABCMeta):
+    # ファイル名・カタログでの名前（Noneならクラス名のスネークケース）
+    name = None
     prefix = ''
     suffix = ''
     dir = '.'
+    # このリストに挙げた特徴量（name）の保存後に実行される
+    depends = []
+    # キャッシュキーに含める入力ファイルとパラメータ
+    inputs = []
+    params = {}
+    # カタログでの検索用タグ
+    tags = []
+    # 保存形式（'feather' または 'parquet'）と1行グループ（レコードバッチ）あたりの行数
+    file_format = 'feather'
+    row_group_size = 100_000
 
     def __init__(self):
-        if self.__class__.__name__.isupper():
-            self.name = self.__class__.__name__.lower()
-        else:
-            self.name = re.sub("([A-Z])", lambda x: "_" + x.group(1).lower(), self.__class__.__name__).lstrip('_')
+        if self.name is None:
+            if self.__class__.__name__.isupper():
+                self.name = self.__class__.__name__.lower()
+            else:
+                self.name = re.sub("([A-Z])", lambda x: "_" + x.group(1).lower(), self.__class__.__name__).lstrip('_')
 
         self.train = pd.DataFrame()
         self.test = pd.DataFrame()
-        self.train_path = Path(self.dir) / f'{self.name}_train.ftr'
-        self.test_path = Path(self.dir) / f'{self.name}_test.ftr'
+        extension = 'parquet' if self.file_format == 'parquet' else 'ftr'
+        self.train_path = Path(self.dir) / f'{self.name}_train.{extension}'
+        self.test_path = Path(self.dir) / f'{self.name}_test.{extension}'
+        self.manifest_path = Path(self.dir) / 'feature_manifest.json'
+
+    def cache_key(self, dependency_keys=(), file_hashes=None):
+        """ソース・入力ファイル・パラメータ・依存特徴量からキャッシュキーを計算"""
+        file_hashes = {} if file_hashes is None else file_hashes
+        try:
+            source = inspect.getsource(self.__class__)
+        except (OSError, TypeError):
+            source = self.__class__.__qualname__
+        payload = {
+            'source': source,
+            'prefix': self.prefix,
+            'suffix': self.suffix,
+            'inputs': {str(path): _hash_file(path, file_hashes) for path in self.inputs},
+            'params': self.params,
+            'depends': list(dependency_keys),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
 
     def run(self):
         with timer(self.name):
             self.create_features()
-            prefix = self.prefix + '_' if self.prefix else ''
-            suffix = '_' + self.suffix if self.suffix else ''
-            self.train.columns = prefix + self.train.columns + suffix
-            self.test.columns = prefix + self.test.columns + suffix
+            self._rename_columns(self.train)
+            self._rename_columns(self.test)
         return self
 
+    def _column_name(self, column):
+        prefix = self.prefix + '_' if self.prefix else ''
+        suffix = '_' + self.suffix if self.suffix else ''
+        return prefix + column + suffix
+
+    def _rename_columns(self, df):
+        df.columns = [self._column_name(col) for col in df.columns]
+        return df
+
     @abstractmethod
     def create_features(self):
         raise NotImplementedError
 
     def save(self):
-        self.train.to_feather(str(self.train_path))
-        self.test.to_feather(str(self.test_path))
+        for df, path in [(self.train, self.train_path), (self.test, self.test_path)]:
+            self._write(df, path)
+            # 全行を書き直したので、以前に追記したパートは不要
+            for part in split_files(path)[1:]:
+                part.unlink()
+
+    def _write(self, df, path):
+        # 列の型は値を表現できる最小の型に縮小し、元の型をファイルに記録する
+        if self.file_format == 'parquet':
+            write_compact_parquet(df, path, row_group_size=self.row_group_size)
+        else:
+            write_compact_feather(df, path, chunksize=self.row_group_size)
+
+    def load(self, columns=None, restore=False):
+        """保存済みの特徴量（追記したパートを含む）を読み込む（restore=Trueなら保存前の型に戻す）"""
+        self.train = read_feature_table(self.train_path, columns).to_pandas()
+        self.test = read_feature_table(self.test_path, columns).to_pandas()
+        if restore:
+            self.train = restore_dtypes(self.train, read_compact_schema(self.train_path))
+            self.test = restore_dtypes(self.test, read_compact_schema(self.test_path))
+
+    def describe(self):
+        """カタログに登録する情報（ファイル・行数・列の型と統計量）"""
+        columns = {}
+        for col in self.train.columns:
+            series = self.train[col]
+            stats = {'dtype': str(series.dtype), 'null_count': int(series.isna().sum())}
+            if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series) and series.notna().any():
+                stats['min'] = series.min().item()
+                stats['max'] = series.max().item()
+            columns[str(col)] = stats
+        return {
+            'name': self.name,
+            'class': self.__class__.__name__,
+            'tags': list(self.tags),
+            'prefix': self.prefix,
+            'suffix': self.suffix,
+            'depends': list(self.depends),
+            'format': self.file_format,
+            'files': {'train': self.train_path.name, 'test': self.test_path.name},
+            'rows': {'train': len(self.train), 'test': len(self.test)},
+            'columns': columns,
+            'built_at': datetime.now().isoformat(timespec='seconds'),
+        }
+
+
+class IncrementalFeature(Feature):
+    """新しい行だけを変換して既存の特徴量ファイルに追記できる特徴量
+
+    mode='rowwise' は各行を独立に変換する特徴量、mode='fitted' は学習データからfitで
+    求めた統計量（self.state）を使って変換する特徴量。fittedの統計量は
+    `{name}_state.json` に保存され、追記時は保存済みの統計量で新しい行を変換する。
+    """
+    mode = 'rowwise'
+    key = 'PassengerId'
+
+    def __init__(self):
+        super().__init__()
+        self.state = {}
+        self.state_path = Path(self.dir) / f'{self.name}_state.json'
+
+    @abstractmethod
+    def read_inputs(self):
+        """元データ (train, test) を返す"""
+        raise NotImplementedError
+
+    def fit(self, train):
+        """変換に使う統計量（JSONに保存できるdict）を返す"""
+        return {}
+
+    @abstractmethod
+    def transform(self, df):
+        """元データの行を特徴量に変換する（fittedならself.stateを使う）"""
+        raise NotImplementedError
+
+    def create_features(self):
+        train, test = self.read_inputs()
+        self.state = self.fit(train) if self.mode == 'fitted' else {}
+        self.train = self.transform(train)
+        self.test = self.transform(test)
+
+    def save(self):
+        super().save()
+        if self.mode == 'fitted':
+            _save_manifest(self.state_path, self.state)
+
+    def append(self, new_rows, split='test'):
+        """新しい行だけを変換し、特徴量ファイルの隣にパート（`{stem}.part-NNNNN{suffix}`）として書き込む
+
+        既存のファイルは読み書きしない（重複の確認のためkey列だけをメモリマップで読む）。
+        keyが既に保存されている行は追記しないため、同じ行を何度渡してもよい。
+
+        Returns:
+            int: 追記した行数
+        """
+        if self.mode == 'fitted':
+            self.state = _load_manifest(self.state_path)
+            if not self.state:
+                raise FileNotFoundError(f'{self.state_path} is not found, run the feature first')
+
+        path = self.train_path if split == 'train' else self.test_path
+        parts = split_files(path)
+        columns = read_feature_table(path).column_names
+        new = self._rename_columns(self.transform(new_rows.copy()))
+        key = self._column_name(self.key)
+        if key in columns and key in new.columns:
+            existing_keys = read_feature_table(path, [key]).column(key).to_numpy()
+            new = new[~new[key].isin(existing_keys)]
+        if new.empty:
+            return 0
 
-    def load(self):
-        self.train = pd.read_feather(str(self.train_path))
-        self.test = pd.read_feather(str(self.test_path))
+        new = new[columns].reset_index(drop=True)
+        setattr(self, split, new)
+        part_path = path.with_name(f'{path.stem}.part-{len(parts):05d}{path.suffix}')
+        tmp_path = path.with_name(f'.{part_path.name}.tmp')
+        self._write(new, tmp_path)
+        tmp_path.replace(part_path)
+
+        from .store import CATALOG_FILE, FeatureStore
+        if (Path(self.dir) / CATALOG_FILE).exists():
+            store = FeatureStore(self.dir)
+            if self.name in store.entries:
+                entry = store.get(self.name)
+                entry['rows'][split] += len(new)
+                store.register(entry)
+        return len(new)
 
 
 class TitanicFeatures(Feature):
+    # 前処理パイプライン（標準化あり）のtitanic_features_*.ftrとは別のファイルに出力する
+    name = 'titanic_unscaled_features'
+    dir = 'data/output'
+    # カテゴリのマッピング（mappingsセクション、前処理と共通）
+    data_config = 'configs/data.yaml'
+    inputs = ['data/input/train.csv', 'data/input/test.csv', data_config]
+
     def create_features(self):
         # データの読み込み
         train = pd.read_csv('data/input/train.csv')
         test = pd.read_csv('data/input/test.csv')
-
-        # 元データを保存
-        train.to_csv('data/output/raw_train.csv', index=False)
-        test.to_csv('data/output/raw_test.csv', index=False)
-        print('[TitanicFeatures] Saved raw train and test data.')
+        with open(self.data_config) as f:
+            mappings = yaml.safe_load(f)['mappings']
+        categorical_mappings = mappings['categorical_mappings']
+        # 敬称の置換・希少敬称の集約・ラベル化をまとめたルックアップ表
+        title_encoder = CategoricalEncoder.for_titles(mappings)
 
         # 特徴量の生成
         for df, name in zip([train, test], ['train', 'test']):
             # 性別を数値に変換
-            df['Sex'] = df['Sex'].map({'male': 0, 'female': 1})
-            print(f'[{name}] Sex: male→0, female→1')
+            df['Sex'] = df['Sex'].map(categorical_mappings['Sex'])
+            _echo(f'[{name}] Sex: male→0, female→1')
 
             # 年齢の欠損値を中央値で補完
-            df['Age'].fillna(df['Age'].median(), inplace=True)
-            print(f'[{name}] Age: fillna with median')
+            df['Age'] = df['Age'].fillna(df['Age'].median())
+            _echo(f'[{name}] Age: fillna with median')
 
             # 運賃の欠損値を中央値で補完
-            df['Fare'].fillna(df['Fare'].median(), inplace=True)
-            print(f'[{name}] Fare: fillna with median')
+            df['Fare'] = df['Fare'].fillna(df['Fare'].median())
+            _echo(f'[{name}] Fare: fillna with median')
 
             # 乗船港の欠損値を最頻値で補完
-            df['Embarked'].fillna(df['Embarked'].mode()[0], inplace=True)
-            df['Embarked'] = df['Embarked'].map({'C': 0, 'Q': 1, 'S': 2})
-            print(f'[{name}] Embarked: fillna with mode, map to int')
+            df['Embarked'] = df['Embarked'].fillna(df['Embarked'].mode()[0]).map(categorical_mappings['Embarked'])
+            _echo(f'[{name}] Embarked: fillna with mode, map to int')
 
             # 家族サイズの特徴量
             df['FamilySize'] = df['SibSp'] + df['Parch'] + 1
-            print(f'[{name}] FamilySize: SibSp + Parch + 1')
+            _echo(f'[{name}] FamilySize: SibSp + Parch + 1')
 
             # 単独旅行者かどうか
             df['IsAlone'] = (df['FamilySize'] == 1).astype(int)
-            print(f'[{name}] IsAlone: FamilySize==1→1, else 0')
+            _echo(f'[{name}] IsAlone: FamilySize==1→1, else 0')
 
             # 名前から敬称を抽出
-            df['Title'] = df['Name'].str.extract(' ([A-Za-z]+)\.', expand=False)
-            df['Title'] = df['Title'].replace(['Lady', 'Countess', 'Capt', 'Col', 'Don', 'Dr', 'Major', 'Rev', 'Sir', 'Jonkheer', 'Dona'], 'Rare')
-            df['Title'] = df['Title'].replace('Mlle', 'Miss')
-            df['Title'] = df['Title'].replace('Ms', 'Miss')
-            df['Title'] = df['Title'].replace('Mme', 'Mrs')
-            title_mapping = {"Mr": 1, "Miss": 2, "Mrs": 3, "Master": 4, "Rare": 5}
-            df['Title'] = df['Title'].map(title_mapping)
-            df['Title'] = df['Title'].fillna(0)
-            print(f'[{name}] Title: extract and map')
+            df['Title'] = title_encoder.transform(extract_title(df['Name']))
+            _echo(f'[{name}] Title: extract and map')
 
         # 使用する特徴量＋ID＋Survived
         feature_cols = ['PassengerId', 'Pclass', 'Sex', 'Age', 'Fare', 'Embarked', 'FamilySize', 'IsAlone', 'Title']
         train_cols = feature_cols + ['Survived']
         self.train = train[train_cols]
         self.test = test[feature_cols]
-
-        # 加工後データを保存
-        self.train.to_feather('data/output/titanic_features_train.ftr')
-        self.test.to_feather('data/output/titanic_features_test.ftr')
-        print('[TitanicFeatures] Saved processed features as feather files.')
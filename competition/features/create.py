@@ -6,12 +6,19 @@ from pathlib import Path
 
 import pandas as pd
 
-from .base import get_arguments, generate_features
+from .base import get_arguments, generate_features, append_features, use_logger
+# このモジュールのglobals()にあるFeatureのサブクラスを生成する（新しい特徴量もこのファイルに定義する）
+from .base import TitanicFeatures  # noqa: F401
 
 
 def create_features():
     args = get_arguments()
-    generate_features(globals(), args.force)
+    if args.log:
+        use_logger()
+    if args.append:
+        append_features(globals(), pd.read_csv(args.append), args.split)
+    else:
+        generate_features(globals(), args.force, args.jobs)
 
 
 if __name__ == '__main__':
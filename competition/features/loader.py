@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from .base import Feature, read_feature_table
+
+# 学習・予測に渡すfloat32行列（行はC連続）と目的変数・キー、カテゴリ列のカテゴリ（学習データから求めたもの）
+FeatureMatrix = namedtuple(
+    'FeatureMatrix',
+    ['X_train', 'y_train', 'X_test', 'feature_names', 'train_keys', 'test_keys', 'categories'],
+    defaults=(None,),
+)
+
+
+def _read_columns(path, columns, key, target):
+    """Feather/Parquetファイル（追記したパートを含む）をメモリマップし、必要な列だけを読み込む"""
+    names = pq.read_schema(str(path)).names if path.suffix == '.parquet' else read_feature_table(path).column_names
+    if columns is None:
+        wanted = names
+    else:
+        wanted = [c for c in names if c in columns or c in (key, target)]
+    return read_feature_table(path, wanted)
+
+
+def _combine(tables, key):
+    """keyで特徴量テーブルを結合する（行順が一致する場合は列の追加のみ）"""
+    combined = tables[0]
+    for table in tables[1:]:
+        if key not in table.column_names:
+            raise KeyError(f'{key} is not in feature table')
+        new_cols = [c for c in table.column_names if c not in combined.column_names]
+        if not new_cols:
+            continue
+        if combined.column(key).equals(table.column(key)):
+            for col in new_cols:
+                combined = combined.append_column(col, table.column(col))
+        else:
+            combined = combined.join(table.select([key] + new_cols), keys=key, join_type='left outer')
+    return combined
+
+
+def _feature_path(feature_dir, name, split, catalog):
+    """特徴量ファイルのパス（カタログに登録されていればその形式、なければ存在するFeather/Parquetファイル）"""
+    if name in catalog:
+        return feature_dir / catalog[name]['files'][split]
+    for extension in ('ftr', 'parquet'):
+        path = feature_dir / f'{name}_{split}.{extension}'
+        if path.exists():
+            return path
+    return feature_dir / f'{name}_{split}.ftr'
+
+
+def _load_tables(names, columns, feature_dir, key, target):
+    from .store import FeatureStore
+
+    feature_dir = Path(Feature.dir if feature_dir is None else feature_dir)
+    columns = None if columns is None else set(columns)
+    catalog = FeatureStore(feature_dir).entries
+
+    result = []
+    for split in ['train', 'test']:
+        tables = [_read_columns(_feature_path(feature_dir, name, split, catalog), columns, key, target)
+                  for name in names]
+        combined = _combine(tables, key)
+        if columns is not None:
+            missing = columns - set(combined.column_names) - {target}
+            if missing:
+                raise KeyError(f'columns not found in features {names}: {sorted(missing)}')
+        result.append(combined)
+    return tuple(result)
+
+
+def load_features(names, columns=None, feature_dir=None, key='PassengerId', target='Survived'):
+    """保存済み特徴量から必要な列だけを読み込み、keyで結合したtrain/testを返す
+
+    Args:
+        names (list): 読み込む特徴量名（`{name}_train.ftr` / `{name}_test.ftr`、Parquetで保存した特徴量も可）
+        columns (list, optional): 読み込む列. Noneなら全列. Defaults to None.
+        feature_dir (str, optional): 特徴量ディレクトリ. Defaults to Feature.dir.
+        key (str, optional): 結合キー. Defaults to 'PassengerId'.
+        target (str, optional): 目的変数（存在すれば常に読み込む）. Defaults to 'Survived'.
+
+    Returns:
+        tuple: (train, test) のDataFrame
+    """
+    # pandasへの変換は結合後の1回のみ
+    return tuple(table.to_pandas() for table in _load_tables(names, columns, feature_dir, key, target))
+
+
+def column_categories(data, columns):
+    """辞書エンコード・カテゴリ列ごとのカテゴリ（値の昇順）
+
+    学習データから求めたカテゴリでテストデータも変換し、同じ値に同じコードを割り当てる
+    （ファイルごとの辞書のindexはファイルによって異なるため使わない）。
+    """
+    categories = {}
+    for col in columns:
+        if isinstance(data, pa.Table):
+            column = data.column(col)
+            if pa.types.is_dictionary(column.type):
+                values = pc.unique(pc.drop_null(column.cast(column.type.value_type)))
+                categories[col] = values.take(pc.sort_indices(values)).to_pylist()
+        elif isinstance(data[col].dtype, pd.CategoricalDtype):
+            categories[col] = data[col].cat.categories.sort_values().tolist()
+    return categories
+
+
+def _column_values(data, col, categories=None):
+    """列の値をNumPy配列で返す（欠損はNaN、カテゴリ・辞書エンコード列はcategoriesでのコード）
+
+    categoriesにない値（学習データに現れなかった値）は欠損として扱う。
+    """
+    if isinstance(data, pa.Table):
+        column = data.column(col)
+        if pa.types.is_dictionary(column.type):
+            values = column.cast(column.type.value_type)
+            if categories is None:
+                categories = column_categories(data, [col])[col]
+            value_set = pa.array(categories, type=column.type.value_type)
+            return pc.index_in(values, value_set=value_set).to_numpy()
+        if not (pa.types.is_integer(column.type) or pa.types.is_floating(column.type)
+                or pa.types.is_boolean(column.type)):
+            raise TypeError(f'column {col} is not numeric ({column.type}), encode it before building a matrix')
+        # 欠損のない1チャンクの数値列はメモリマップしたバッファをそのまま参照する
+        return column.to_numpy()
+    series = data[col]
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        if categories is None:
+            categories = series.cat.categories.sort_values()
+        codes = pd.Categorical(series, categories=categories).codes.astype(np.float32)
+        codes[codes < 0] = np.nan
+        return codes
+    if not (pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series)):
+        raise TypeError(f'column {col} is not numeric ({series.dtype}), encode it before building a matrix')
+    return series.to_numpy(dtype=np.float32, na_value=np.nan)
+
+
+def _native_values(data, col):
+    """キー・目的変数の列を元の型のままNumPy配列で返す（float32に変換するとIDの表記や大きな値が変わるため）"""
+    if isinstance(data, pa.Table):
+        return data.column(col).to_numpy()
+    return data[col].to_numpy()
+
+
+def to_matrix(data, columns, dtype=np.float32, categories=None):
+    """Arrowテーブル/DataFrameの列を、事前に確保したC連続の行列へ1回だけ書き込む
+
+    Args:
+        data (pa.Table or pd.DataFrame): 対象のデータ
+        columns (list): 行列にする列
+        dtype (np.dtype, optional): 行列の型. Defaults to np.float32.
+        categories (dict, optional): カテゴリ列ごとのカテゴリ（column_categories）. Defaults to dataから求める.
+    """
+    if categories is None:
+        categories = column_categories(data, columns)
+    n_rows = data.num_rows if isinstance(data, pa.Table) else len(data)
+    matrix = np.empty((n_rows, len(columns)), dtype=dtype)
+    for j, col in enumerate(columns):
+        matrix[:, j] = _column_values(data, col, categories.get(col))
+    return matrix
+
+
+def make_feature_matrix(train, test, key='PassengerId', target='Survived'):
+    """train/test（ArrowテーブルまたはDataFrame）からFeatureMatrixを作る
+
+    key・target以外の列を特徴量とし、各splitにつき行列を1つだけ作る
+    （DataFrameのdrop・フォールドごとのiloc等の中間コピーを作らない）。
+    カテゴリ列はtrainのカテゴリでtrain/testの両方をコードにする。
+    """
+    train_columns = train.column_names if isinstance(train, pa.Table) else list(train.columns)
+    feature_names = [col for col in train_columns if col not in (key, target)]
+    categories = column_categories(train, feature_names)
+    return FeatureMatrix(
+        X_train=to_matrix(train, feature_names, categories=categories),
+        y_train=_native_values(train, target),
+        X_test=to_matrix(test, feature_names, categories=categories),
+        feature_names=feature_names,
+        train_keys=_native_values(train, key),
+        test_keys=_native_values(test, key),
+        categories=categories,
+    )
+
+
+def load_feature_matrix(names, columns=None, feature_dir=None, key='PassengerId', target='Survived'):
+    """保存済み特徴量をメモリマップしたArrowテーブルから直接float32行列にする（pandasを経由しない）
+
+    引数はload_featuresと同じ。
+
+    Returns:
+        FeatureMatrix: 特徴量行列・目的変数・キー
+    """
+    train, test = _load_tables(names, columns, feature_dir, key, target)
+    return make_feature_matrix(train, test, key, target)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+from fnmatch import fnmatch
+from pathlib import Path
+
+from .base import Feature, _load_manifest, _save_manifest, read_feature_table, split_files
+from .loader import _combine
+
+CATALOG_FILE = 'feature_catalog.json'
+
+
+class FeatureStore:
+    """特徴量ディレクトリのカタログ（feature_catalog.json）を管理する
+
+    カタログには特徴量ごとのファイル・形式・行数・列の型と統計量・タグ・生成日時を記録する。
+    一覧や検索はカタログだけで行い、特徴量ファイルは読み込むときにだけ開く。
+    """
+
+    def __init__(self, root=None):
+        self.root = Path(Feature.dir if root is None else root)
+        self.catalog_path = self.root / CATALOG_FILE
+        self.entries = _load_manifest(self.catalog_path)
+        self._build_index()
+
+    def _build_index(self):
+        self._by_tag = defaultdict(set)
+        self._by_column = defaultdict(set)
+        for name, entry in self.entries.items():
+            for tag in entry.get('tags', []):
+                self._by_tag[tag].add(name)
+            for col in entry.get('columns', {}):
+                self._by_column[col].add(name)
+
+    def register(self, entry):
+        """特徴量の情報（Feature.describe()）をカタログに登録して保存"""
+        self.entries[entry['name']] = entry
+        self._build_index()
+        _save_manifest(self.catalog_path, self.entries)
+
+    def add(self, feature):
+        """保存済みのFeatureをカタログに登録"""
+        self.register(feature.describe())
+
+    def remove(self, name, delete_files=False):
+        """カタログから特徴量を削除（delete_files=Trueならファイルも削除）"""
+        entry = self.entries.pop(name)
+        if delete_files:
+            for filename in entry['files'].values():
+                for path in split_files(self.root / filename):
+                    path.unlink(missing_ok=True)
+        self._build_index()
+        _save_manifest(self.catalog_path, self.entries)
+
+    def get(self, name):
+        return self.entries[name]
+
+    def find(self, name=None, tag=None, prefix=None, suffix=None, column=None):
+        """条件に一致する特徴量名の一覧（nameはワイルドカード可）"""
+        if tag is not None:
+            candidates = sorted(self._by_tag.get(tag, ()))
+        elif column is not None:
+            candidates = sorted(self._by_column.get(column, ()))
+        else:
+            candidates = sorted(self.entries)
+
+        result = []
+        for feature_name in candidates:
+            entry = self.entries[feature_name]
+            if name is not None and not fnmatch(feature_name, name):
+                continue
+            if prefix is not None and entry.get('prefix') != prefix:
+                continue
+            if suffix is not None and entry.get('suffix') != suffix:
+                continue
+            result.append(feature_name)
+        return result
+
+    def columns(self, names=None):
+        """特徴量ごとの列名（ファイルを開かずカタログから返す）"""
+        names = sorted(self.entries) if names is None else names
+        return {name: list(self.entries[name]['columns']) for name in names}
+
+    def _read(self, name, split, columns, key, target):
+        entry = self.entries[name]
+        path = self.root / entry['files'][split]
+        wanted = None
+        if columns is not None:
+            wanted = [c for c in entry['columns'] if c in columns or c in (key, target)]
+            if split == 'test':
+                wanted = [c for c in wanted if c != target]
+        if wanted is not None and entry['format'] != 'parquet':
+            names = read_feature_table(path).column_names
+            wanted = [c for c in wanted if c in names]
+        return read_feature_table(path, wanted)
+
+    def load(self, names, columns=None, key='PassengerId', target='Survived'):
+        """特徴量から必要な列だけを読み込み、keyで結合したtrain/testを返す（Feather/Parquet両対応）"""
+        columns = None if columns is None else set(columns)
+        result = []
+        for split in ['train', 'test']:
+            tables = [self._read(name, split, columns, key, target) for name in names]
+            result.append(_combine(tables, key).to_pandas())
+        return tuple(result)
@@ -1,6 +1,29 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from .lgbm import LGBMModel
+import importlib
 
-__all__ = ['LGBMModel']
\ No newline at end of file
+from .base import BaseModel
+from .lgbm import LGBMModel, DatasetCache
+
+# 推論（predict.py）で読み込まないモジュールは、最初に参照したときにimportする
+_LAZY_ATTRS = {
+    'SklearnModel': 'sklearn_model',
+    'FoldCache': 'splitter',
+    'get_splitter': 'splitter',
+    'create_model': 'ensemble',
+    'cross_validate': 'ensemble',
+    'load_predictions': 'ensemble',
+    'stack': 'ensemble',
+    'weighted_vote': 'ensemble',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        return getattr(importlib.import_module(f'.{_LAZY_ATTRS[name]}', __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+__all__ = ['BaseModel', 'LGBMModel', 'SklearnModel', 'DatasetCache', 'FoldCache', 'get_splitter',
+           'create_model', 'cross_validate', 'load_predictions', 'stack', 'weighted_vote']
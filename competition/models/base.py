@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from abc import ABC, abstractmethod
+
+
+class BaseModel(ABC):
+    """アンサンブルで扱うモデルの共通インターフェース
+
+    モデルの設定（name・type・params等）を受け取って作成し、trainで学習、
+    predictで正例の予測確率を返す。学習済みモデルはsave・loadで保存・復元する。
+    """
+
+    def __init__(self, params):
+        self.params = params
+
+    @abstractmethod
+    def train(self, X, y, X_val=None, y_val=None):
+        """モデルを学習（検証データは早期終了等に使う）"""
+
+    @abstractmethod
+    def predict(self, X):
+        """正例の予測確率を返す"""
+
+    @abstractmethod
+    def save(self, model_dir):
+        """学習済みモデルをディレクトリに保存"""
+
+    @classmethod
+    @abstractmethod
+    def load(cls, model_dir):
+        """saveで保存したモデルを読み込む"""
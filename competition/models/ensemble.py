@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+from sklearn.metrics import accuracy_score
+
+from .lgbm import LGBMModel
+from .sklearn_model import SklearnModel
+
+# モデル設定のtypeで指定できるモデル
+MODEL_TYPES = {
+    'lightgbm': LGBMModel,
+    'sklearn': SklearnModel,
+}
+
+
+def create_model(model_config):
+    """モデル設定（typeの既定はlightgbm）からBaseModelを作る"""
+    model_type = model_config.get('type', 'lightgbm')
+    if model_type not in MODEL_TYPES:
+        raise ValueError(f'unsupported model type: {model_type} (choose from {tuple(MODEL_TYPES)})')
+    return MODEL_TYPES[model_type](model_config)
+
+
+def oof_score(y, preds):
+    """OOF予測の正解率（しきい値0.5）"""
+    return accuracy_score(y, (np.asarray(preds) > 0.5).astype(int))
+
+
+def cross_validate(model_config, folds, X_train, y_train, X_test=None):
+    """共通のフォールドでモデルを学習し、OOF予測とフォールドごとのテスト予測を返す
+
+    ベースモデル（特徴量行列）とメタモデル（ベースモデルのOOF予測の行列）の両方に使う。
+
+    Args:
+        model_config (dict): モデル設定
+        folds (list): (フォールド番号, 学習index, 検証index) のリスト
+        X_train (np.ndarray): 学習データ
+        y_train (np.ndarray): 目的変数
+        X_test (np.ndarray, optional): テストデータ. Defaults to None (テスト予測を行わない).
+
+    Returns:
+        tuple: OOF予測（繰り返しのある分割では平均）, フォールドごとのテスト予測, フォールドごとの正解率
+    """
+    n_train = len(y_train)
+    oof_preds = np.zeros(n_train, dtype=np.float64)
+    counts = np.zeros(n_train, dtype=np.int32)
+    fold_test_preds = None if X_test is None else np.zeros((len(folds), len(X_test)), dtype=np.float64)
+    scores = []
+    for fold, train_idx, val_idx in folds:
+        model = create_model(model_config)
+        model.train(X_train[train_idx], y_train[train_idx], X_train[val_idx], y_train[val_idx])
+        val_preds = model.predict(X_train[val_idx])
+        oof_preds[val_idx] += val_preds
+        counts[val_idx] += 1
+        scores.append(oof_score(y_train[val_idx], val_preds))
+        if X_test is not None:
+            fold_test_preds[fold - 1] = model.predict(X_test)
+    oof_preds /= np.maximum(counts, 1)
+    return oof_preds, fold_test_preds, scores
+
+
+def save_predictions(oof_dir, name, oof_preds, fold_test_preds):
+    """OOF予測とフォールドごとのテスト予測を`{name}_oof.npy`・`{name}_test.npy`に保存（run.pyと同じ形式）"""
+    oof_dir = Path(oof_dir)
+    oof_dir.mkdir(parents=True, exist_ok=True)
+    np.save(oof_dir / f'{name}_oof.npy', np.asarray(oof_preds, dtype=np.float64))
+    np.save(oof_dir / f'{name}_test.npy', np.asarray(fold_test_preds, dtype=np.float64))
+
+
+def prediction_key(model_config, feature_names, folds, X_train, y_train, X_test):
+    """保存済みの予測を再利用してよいかを判定するキー
+
+    モデル設定・特徴量名・フォールド（検証index）・データのハッシュ。
+    どれかが変われば別のキーになり、ベースモデルを学習し直す。
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps({'model': model_config, 'features': list(feature_names)},
+                        sort_keys=True, default=str).encode())
+    for fold, _, val_idx in folds:
+        h.update(np.int64(fold).tobytes())
+        h.update(np.ascontiguousarray(val_idx, dtype=np.int64).tobytes())
+    for array in (X_train, y_train, X_test):
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()[:16]
+
+
+def _key_path(oof_dir, name):
+    return Path(oof_dir) / f'{name}_oof.json'
+
+
+def save_prediction_key(oof_dir, name, key):
+    """予測を作ったときのキーを`{name}_oof.json`に記録する（予測の保存が終わってから呼ぶ）"""
+    with open(_key_path(oof_dir, name), 'w') as f:
+        json.dump({'key': key}, f)
+
+
+def clear_prediction_key(oof_dir, name):
+    """学習し直す前にキーを消す（途中で失敗した予測を再利用しないように）"""
+    _key_path(oof_dir, name).unlink(missing_ok=True)
+
+
+def has_predictions(oof_dir, name, key):
+    """保存済みの予測があり、記録したキーがkeyと一致するか"""
+    oof_dir = Path(oof_dir)
+    key_path = _key_path(oof_dir, name)
+    if not (key_path.exists() and (oof_dir / f'{name}_oof.npy').exists()
+            and (oof_dir / f'{name}_test.npy').exists()):
+        return False
+    with open(key_path) as f:
+        return json.load(f).get('key') == key
+
+
+def load_predictions(oof_dir, names):
+    """保存済みの予測をモデルごとの列に並べた行列として読み込む
+
+    Returns:
+        tuple: OOF予測 (n_train, n_models), テスト予測（フォールドの平均） (n_test, n_models)
+    """
+    oof_dir = Path(oof_dir)
+    oof_preds = np.column_stack([np.load(oof_dir / f'{name}_oof.npy', mmap_mode='r') for name in names])
+    test_preds = np.column_stack(
+        [np.load(oof_dir / f'{name}_test.npy', mmap_mode='r').mean(axis=0) for name in names]
+    )
+    return oof_preds, test_preds
+
+
+def weighted_vote(preds, weights=None):
+    """モデルごとの予測確率の列 (n_rows, n_models) を重み付き平均する（行列積1回）
+
+    Args:
+        preds (np.ndarray): モデルごとの予測確率
+        weights (list, optional): モデルごとの重み（合計1に正規化する）. Defaults to None (等重み).
+
+    Returns:
+        np.ndarray: 予測確率
+    """
+    preds = np.asarray(preds, dtype=np.float64)
+    n_models = preds.shape[1]
+    weights = np.ones(n_models) if weights is None else np.asarray(weights, dtype=np.float64)
+    if weights.shape != (n_models,):
+        raise ValueError(f'expected {n_models} voting weights, got {len(weights)}')
+    return preds @ (weights / weights.sum())
+
+
+def stack(meta_config, folds, oof_preds, y_train, test_preds):
+    """ベースモデルのOOF予測でメタモデルを学習する（ベースモデルは再学習しない）
+
+    メタモデルもベースモデルと同じフォールドで学習し、レベル2のOOF予測で評価する。
+    テスト予測はフォールドごとのメタモデルの平均。
+
+    Returns:
+        tuple: レベル2のOOF予測, テスト予測
+    """
+    meta_oof, fold_test_preds, _ = cross_validate(meta_config, folds, oof_preds, y_train, test_preds)
+    return meta_oof, fold_test_preds.mean(axis=0)
@@ -1,46 +1,206 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import lightgbm as lgb
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import KFold
 
+from .base import BaseModel
+
+# Datasetの構築（ビン化）に影響するパラメータ
+DATASET_PARAMS = (
+    'max_bin', 'max_bin_by_feature', 'min_data_in_bin', 'bin_construct_sample_cnt',
+    'data_random_seed', 'use_missing', 'zero_as_missing', 'categorical_feature',
+    'linear_tree', 'verbose',
+)
+
+
+class DatasetCache:
+    """特徴量行列ごとにビン化済みのlgb.Datasetをバイナリ保存して再利用する
+
+    キーは特徴量行列・目的変数・ビン化パラメータのハッシュ。フォールドは
+    `Dataset.subset`で行を選ぶだけなので、ビン化は行列ごとに1回で済む。
+    """
+
+    def __init__(self, cache_dir, params=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.params = {k: v for k, v in (params or {}).items() if k in DATASET_PARAMS}
+        # 学習時のmin_data_in_leaf等を変えても再構築が要らないようにする
+        self.params['feature_pre_filter'] = False
+
+    def key(self, X, y, feature_names=None):
+        h = hashlib.sha256()
+        if isinstance(X, np.ndarray):
+            # 行列のバッファをそのままハッシュする（コピーしない）
+            h.update(json.dumps([feature_names, str(X.dtype), X.shape, self.params], sort_keys=True).encode())
+            h.update(memoryview(np.ascontiguousarray(X)).cast('B'))
+            h.update(np.ascontiguousarray(y).tobytes())
+        else:
+            h.update(json.dumps([list(map(str, X.columns)), list(map(str, X.dtypes)), self.params],
+                                sort_keys=True).encode())
+            h.update(pd.util.hash_pandas_object(X, index=False).values.tobytes())
+            h.update(pd.util.hash_pandas_object(y, index=False).values.tobytes())
+        return h.hexdigest()[:16]
+
+    def build(self, X, y, feature_names=None):
+        """ビン化済みDatasetのバイナリを用意してパスを返す（キャッシュ済みなら何もしない）
+
+        Xがfloat32のC連続行列ならLightGBMは変換せずにそのまま読み込む。
+        """
+        path = self.cache_dir / f'{self.key(X, y, feature_names)}.bin'
+        if not path.exists():
+            dataset = lgb.Dataset(X, y, feature_name=feature_names or 'auto', params=self.params).construct()
+            tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+            dataset.save_binary(str(tmp_path))
+            tmp_path.replace(path)
+        return path
+
+    def load(self, path):
+        """バイナリからビン化済みDatasetを読み込む"""
+        return lgb.Dataset(str(path), params=self.params).construct()
 
-class LGBMModel:
+
+class LGBMModel(BaseModel):
     def __init__(self, params):
-        self.params = params
+        super().__init__(params)
         self.models = []
+        # 各モデルの最良イテレーション
+        self.best_iterations = []
+
+    def train(self, X, y, X_val=None, y_val=None, num_boost_round=None):
+        """LightGBMモデルを学習
+
+        学習設定（params['train']）のearly_stopping_roundsが指定されていれば、
+        検証データのスコアで早期終了する。
 
-    def train(self, X, y, X_val=None, y_val=None):
+        Args:
+            X (pd.DataFrame): 学習データ
+            y (pd.Series): 目的変数
+            X_val (pd.DataFrame, optional): 検証データ. Defaults to None.
+            y_val (pd.Series, optional): 検証データの目的変数. Defaults to None.
+            num_boost_round (int, optional): 最大ラウンド数. Defaults to params['train']['num_boost_round'] (1000).
+        """
+        train_set = lgb.Dataset(X, y)
+        valid_set = None
         # バリデーションデータが与えられている場合
         if X_val is not None and y_val is not None:
-            train_set = lgb.Dataset(X, y)
             valid_set = lgb.Dataset(X_val, y_val, reference=train_set)
+        self.train_dataset(train_set, valid_set, num_boost_round)
+
+    def train_dataset(self, train_set, valid_set=None, num_boost_round=None, callbacks=None):
+        """構築済みのlgb.Dataset（DatasetCacheのsubset等）で学習
+
+        Args:
+            train_set (lgb.Dataset): 学習データ
+            valid_set (lgb.Dataset, optional): 検証データ. Defaults to None.
+            num_boost_round (int, optional): 最大ラウンド数. Defaults to params['train']['num_boost_round'] (1000).
+            callbacks (list, optional): 追加のLightGBMコールバック（枝刈り等）. Defaults to None.
+        """
+        train_params = self.params.get('train', {})
+        if num_boost_round is None:
+            num_boost_round = train_params.get('num_boost_round', 1000)
+        callbacks = [lgb.log_evaluation(period=train_params.get('verbose', 100))] + list(callbacks or [])
+
+        if valid_set is not None:
+            early_stopping_rounds = train_params.get('early_stopping_rounds')
+            if early_stopping_rounds:
+                callbacks.append(lgb.early_stopping(early_stopping_rounds, verbose=False))
             model = lgb.train(
                 params=self.params['params'],
                 train_set=train_set,
                 valid_sets=[train_set, valid_set],
-                num_boost_round=1000,
-                callbacks=[lgb.log_evaluation(period=100)]
+                valid_names=['train', 'valid'],
+                num_boost_round=num_boost_round,
+                callbacks=callbacks
             )
-            self.models.append(model)
+            best_iteration = model.best_iteration if model.best_iteration > 0 else model.current_iteration()
         else:
             # 全データで学習
-            train_set = lgb.Dataset(X, y)
             model = lgb.train(
                 params=self.params['params'],
                 train_set=train_set,
-                num_boost_round=1000,
-                callbacks=[lgb.log_evaluation(period=100)]
+                num_boost_round=num_boost_round,
+                callbacks=callbacks
             )
-            self.models.append(model)
-
-    def predict(self, X):
-        # 予測（確率値を返す）
-        preds = []
-        for model in self.models:
-            pred = model.predict(X)
-            preds.append(pred)
-        pred = np.mean(preds, axis=0)
+            best_iteration = model.current_iteration()
+        self.models.append(model)
+        self.best_iterations.append(best_iteration)
+
+    def predict(self, X, weights=None, batch_size=100_000, n_jobs=None):
+        """アンサンブルの予測確率（重み付き平均）を返す
+
+        行をバッチに分割してスレッドで並列に予測し（LightGBMは予測中GILを解放する）、
+        各バッチの結果は事前に確保した1つの出力配列へ直接加算する。
+
+        Args:
+            X (pd.DataFrame or np.ndarray): 予測対象
+            weights (list, optional): モデルごとの重み. Defaults to None (等重み).
+            batch_size (int, optional): 1バッチの最大行数. Defaults to 100_000.
+            n_jobs (int, optional): スレッド数. Defaults to CPUコア数.
+
+        Returns:
+            np.ndarray: 予測確率
+        """
+        weights = np.ones(len(self.models)) if weights is None else np.asarray(weights, dtype=np.float64)
+        weights = weights / weights.sum()
+        n_rows = len(X)
+        n_jobs = n_jobs or os.cpu_count() or 1
+        # スレッドが余らないようにバッチを分割（小さすぎるバッチは作らない）
+        batch_size = min(batch_size, max(1024, -(-n_rows // n_jobs)))
+        starts = range(0, n_rows, batch_size)
+        parallel = n_jobs > 1 and len(starts) > 1
+        # スレッド並列時はLightGBM内部のスレッドを1つに抑える
+        predict_params = {'num_threads': 1} if parallel else {}
+
+        pred = np.zeros(n_rows, dtype=np.float64)
+
+        def predict_batch(start):
+            stop = min(start + batch_size, n_rows)
+            X_batch = X[start:stop] if isinstance(X, np.ndarray) else X.iloc[start:stop]
+            for model, weight in zip(self.models, weights):
+                pred[start:stop] += weight * model.predict(X_batch, **predict_params)
+
+        if parallel:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                list(executor.map(predict_batch, starts))
+        else:
+            for start in starts:
+                predict_batch(start)
         return pred
+
+    def save(self, model_dir):
+        """学習済みモデルをLightGBMのテキスト形式で保存（最良イテレーションまで）"""
+        model_dir = Path(model_dir)
+        model_dir.mkdir(parents=True, exist_ok=True)
+        for i, model in enumerate(self.models):
+            model.save_model(str(model_dir / f'model_{i}.txt'))
+        meta = {
+            'params': self.params,
+            'n_models': len(self.models),
+            'best_iterations': self.best_iterations,
+            'feature_names': self.feature_names,
+        }
+        with open(model_dir / 'model.json', 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, model_dir):
+        """saveで保存したモデルを読み込む"""
+        model_dir = Path(model_dir)
+        with open(model_dir / 'model.json') as f:
+            meta = json.load(f)
+        model = cls(meta['params'])
+        model.models = [lgb.Booster(model_file=str(model_dir / f'model_{i}.txt')) for i in range(meta['n_models'])]
+        model.best_iterations = meta['best_iterations']
+        return model
+
+    @property
+    def feature_names(self):
+        return self.models[0].feature_name() if self.models else []
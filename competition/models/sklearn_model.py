@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import pickle
+from pathlib import Path
+
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+from .base import BaseModel
+
+# params['estimator']で指定できる推定器
+ESTIMATORS = {
+    'logistic_regression': LogisticRegression,
+    'random_forest': RandomForestClassifier,
+    'extra_trees': ExtraTreesClassifier,
+}
+
+
+class SklearnModel(BaseModel):
+    """scikit-learnの分類器（欠損の補完・標準化つき）をBaseModelとして扱う
+
+    設定の例: {"name": "logreg", "type": "sklearn", "estimator": "logistic_regression", "params": {"C": 1.0}}
+    """
+
+    def __init__(self, params):
+        super().__init__(params)
+        self.model = None
+
+    def train(self, X, y, X_val=None, y_val=None):
+        """全行で学習（検証データは使わない）"""
+        name = self.params.get('estimator', 'logistic_regression')
+        if name not in ESTIMATORS:
+            raise ValueError(f'unsupported estimator: {name} (choose from {tuple(ESTIMATORS)})')
+        estimator = ESTIMATORS[name](**self.params.get('params', {}))
+        self.model = make_pipeline(SimpleImputer(strategy='median'), StandardScaler(), estimator)
+        self.model.fit(X, y)
+
+    def predict(self, X):
+        return self.model.predict_proba(X)[:, 1]
+
+    def save(self, model_dir):
+        model_dir = Path(model_dir)
+        model_dir.mkdir(parents=True, exist_ok=True)
+        with open(model_dir / 'model.pkl', 'wb') as f:
+            pickle.dump(self.model, f)
+        with open(model_dir / 'model.json', 'w') as f:
+            json.dump({'params': self.params}, f, indent=2)
+
+    @classmethod
+    def load(cls, model_dir):
+        model_dir = Path(model_dir)
+        with open(model_dir / 'model.json') as f:
+            meta = json.load(f)
+        model = cls(meta['params'])
+        with open(model_dir / 'model.pkl', 'rb') as f:
+            model.model = pickle.load(f)
+        return model
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import (
+    GroupKFold, KFold, RepeatedStratifiedKFold, StratifiedGroupKFold, StratifiedKFold
+)
+
+# 対応する分割方法
+CV_STRATEGIES = ('kfold', 'stratified', 'group', 'stratified_group', 'repeated_stratified')
+GROUP_STRATEGIES = ('group', 'stratified_group')
+
+
+def get_splitter(strategy='stratified', n_splits=5, random_state=42, n_repeats=1):
+    """分割方法の名前からscikit-learnの分割器を作る"""
+    if strategy == 'kfold':
+        return KFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    if strategy == 'stratified':
+        return StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    if strategy == 'group':
+        return GroupKFold(n_splits=n_splits)
+    if strategy == 'stratified_group':
+        return StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    if strategy == 'repeated_stratified':
+        return RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats, random_state=random_state)
+    raise ValueError(f'unsupported cv strategy: {strategy} (choose from {CV_STRATEGIES})')
+
+
+class FoldCache:
+    """フォールドの検証indexをint32配列で保存し、モデル・試行・スタッキングの段で再利用する
+
+    キーは目的変数・グループ・分割設定のハッシュ（分割器が使うのは行数・目的変数・グループのみ）。
+    各フォールドの学習indexは検証index以外の行として復元する。
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, y, groups, settings):
+        h = hashlib.sha256()
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        h.update(np.asarray(y, dtype=np.float64).tobytes())
+        if groups is not None:
+            h.update(pd.util.hash_pandas_object(pd.Series(groups), index=False).values.tobytes())
+        return h.hexdigest()[:16]
+
+    def get(self, y, groups=None, strategy='stratified', n_splits=5, random_state=42, n_repeats=1):
+        """(フォールド番号, 学習index, 検証index) のリストを返す（キャッシュがなければ分割して保存）"""
+        if strategy in GROUP_STRATEGIES and groups is None:
+            raise ValueError(f'cv strategy {strategy} requires groups')
+        settings = {'strategy': strategy, 'n_splits': n_splits, 'random_state': random_state,
+                    'n_repeats': n_repeats, 'n_rows': len(y)}
+        path = self.cache_dir / f'{self.key(y, groups, settings)}.npz'
+        if path.exists():
+            with np.load(path) as saved:
+                val_indices, offsets = saved['val_indices'], saved['offsets']
+        else:
+            splitter = get_splitter(strategy, n_splits, random_state, n_repeats)
+            val_folds = [val_idx for _, val_idx in splitter.split(np.zeros((len(y), 1)), y, groups)]
+            val_indices = np.concatenate(val_folds).astype(np.int32)
+            offsets = np.cumsum([0] + [len(val_idx) for val_idx in val_folds]).astype(np.int32)
+            tmp_path = path.with_name(f'{path.stem}.{os.getpid()}.tmp.npz')
+            np.savez(tmp_path, val_indices=val_indices, offsets=offsets)
+            tmp_path.replace(path)
+
+        folds = []
+        for fold in range(1, len(offsets)):
+            val_idx = val_indices[offsets[fold - 1]:offsets[fold]]
+            mask = np.ones(len(y), dtype=bool)
+            mask[val_idx] = False
+            folds.append((fold, np.flatnonzero(mask).astype(np.int32), val_idx))
+        return folds
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+TITLES = ['Mr', 'Miss', 'Mrs', 'Master', 'Dr', 'Rev', 'Mlle', 'Col', 'Ms', 'Countess']
+TITLE_PROBS = [0.58, 0.2, 0.14, 0.045, 0.01, 0.008, 0.005, 0.005, 0.004, 0.003]
+
+
+def make_titanic_data(n_rows, seed=42, with_target=True, start_id=1):
+    """Titanicと同じスキーマの合成データを生成"""
+    rng = np.random.default_rng(seed)
+    sex = rng.choice(['male', 'female'], n_rows, p=[0.65, 0.35])
+    title = rng.choice(TITLES, n_rows, p=np.array(TITLE_PROBS) / sum(TITLE_PROBS))
+    surname = pd.Series(rng.integers(0, 5000, n_rows)).map('Surname{}'.format)
+    name = surname + ', ' + pd.Series(title) + '. Firstname'
+
+    age = rng.normal(30, 14, n_rows).clip(0.4, 80).round(1)
+    age[rng.random(n_rows) < 0.2] = np.nan
+    fare = rng.lognormal(2.7, 1.0, n_rows).round(4)
+    fare[rng.random(n_rows) < 0.001] = np.nan
+    embarked = rng.choice(['S', 'C', 'Q'], n_rows, p=[0.72, 0.19, 0.09]).astype(object)
+    embarked[rng.random(n_rows) < 0.002] = None
+    cabin = np.where(rng.random(n_rows) < 0.77, None, 'C85').astype(object)
+
+    df = pd.DataFrame({
+        'PassengerId': np.arange(start_id, start_id + n_rows),
+        'Pclass': rng.choice([1, 2, 3], n_rows, p=[0.24, 0.21, 0.55]),
+        'Name': name,
+        'Sex': sex,
+        'Age': age,
+        'SibSp': rng.poisson(0.5, n_rows),
+        'Parch': rng.poisson(0.4, n_rows),
+        'Ticket': 'A/5 21171',
+        'Fare': fare,
+        'Cabin': cabin,
+        'Embarked': embarked,
+    })
+    if with_target:
+        logit = -0.5 + 2.5 * (sex == 'female') - 0.6 * (df['Pclass'] - 2)
+        df.insert(1, 'Survived', (rng.random(n_rows) < 1 / (1 + np.exp(-logit))).astype(int))
+    return df
+
+
+class _PeakRSS(threading.Thread):
+    """/proc/self/statmをサンプリングして区間内のピークRSSを測る（非Linuxではru_maxrss）"""
+
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self.peak = self.current()
+        self._stop_event = threading.Event()
+
+    def current(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self.page_size
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, self.current())
+        return self.peak
+
+
+@contextmanager
+def measure(results, name, n_rows):
+    """区間の実行時間・ピークRSS・行数/秒を記録"""
+    sampler = _PeakRSS()
+    sampler.start()
+    t0 = time.perf_counter()
+    yield
+    wall = time.perf_counter() - t0
+    peak = sampler.stop()
+    results[name] = {
+        'wall_s': wall,
+        'peak_rss_mb': peak / 2 ** 20,
+        'rows_per_s': n_rows / wall if wall > 0 else None,
+    }
+    print(f'  {name}: {wall:.3f} s, peak RSS {peak / 2 ** 20:.0f} MB')
+
+
+def run_scale(n_rows, num_boost_round, n_splits, workdir):
+    """1つのデータ規模でホットパスを計測"""
+    from features.base import TitanicFeatures
+    from features.loader import make_feature_matrix
+    from models.lgbm import DatasetCache, LGBMModel
+    from models.splitter import FoldCache
+    from preprocessing import TitanicPreprocessor
+    from run import train_fold
+
+    results = {}
+    n_test = max(1, n_rows // 2)
+    input_dir = workdir / 'data' / 'input'
+    output_dir = workdir / 'data' / 'output'
+    input_dir.mkdir(parents=True, exist_ok=True)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    make_titanic_data(n_rows).to_csv(input_dir / 'train.csv', index=False)
+    make_titanic_data(n_test, seed=0, with_target=False, start_id=n_rows + 1).to_csv(input_dir / 'test.csv', index=False)
+    # 前処理設定（マッピング・標準化など）は実際の設定ファイルをそのまま使う
+    (workdir / 'configs').mkdir(exist_ok=True)
+    shutil.copy('configs/data.yaml', workdir / 'configs' / 'data.yaml')
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with measure(results, 'preprocess', n_rows + n_test):
+            train, test = TitanicPreprocessor().preprocess()
+
+        feature = TitanicFeatures()
+        with measure(results, 'feature_run', n_rows + n_test):
+            feature.run()
+        with measure(results, 'feature_save', n_rows + n_test):
+            feature.save()
+        with measure(results, 'feature_load', n_rows + n_test):
+            feature.load()
+
+        # run.pyと同じ経路（float32行列・ビン化済みDatasetのキャッシュ・キャッシュしたフォールド）
+        with measure(results, 'feature_matrix', n_rows + n_test):
+            data = make_feature_matrix(train, test)
+        model_config = {
+            'params': {'objective': 'binary', 'metric': 'binary_logloss', 'verbose': -1},
+            'train': {'num_boost_round': num_boost_round, 'verbose': num_boost_round},
+        }
+        cache = DatasetCache(workdir / 'data' / 'processed' / 'lgb_datasets', model_config['params'])
+        with measure(results, 'build_dataset', n_rows):
+            dataset = cache.load(cache.build(data.X_train, data.y_train, data.feature_names))
+        folds = FoldCache(workdir / 'data' / 'processed' / 'folds').get(
+            data.y_train, strategy='kfold', n_splits=n_splits, random_state=42
+        )
+
+        model = LGBMModel(model_config)
+        for fold, train_idx, val_idx in folds:
+            with measure(results, f'train_fold_{fold}', len(train_idx)):
+                _, fold_model, _, _, _ = train_fold(model_config, fold, train_idx, val_idx,
+                                                    data.X_train, data.y_train, dataset=dataset)
+            model.models.extend(fold_model.models)
+
+        with measure(results, 'predict', n_test):
+            model.predict(data.X_test)
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def run_benchmarks(args):
+    record = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'num_boost_round': args.num_boost_round,
+        'scales': {},
+    }
+    for n_rows in args.scales:
+        print(f'[benchmark] {n_rows} rows')
+        with tempfile.TemporaryDirectory() as workdir:
+            record['scales'][str(n_rows)] = run_scale(n_rows, args.num_boost_round, args.n_splits, Path(workdir))
+
+    history = Path(args.history)
+    history.parent.mkdir(parents=True, exist_ok=True)
+    with open(history, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    print(f'[benchmark] appended results to {history}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(record, f, indent=2)
+        print(f'[benchmark] saved baseline to {args.save_baseline}')
+
+
+def compare(args):
+    """最新の計測結果をベースラインと比較し、閾値を超えて遅くなった区間を報告"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.history) as f:
+        current = json.loads(f.readlines()[-1])
+
+    regressions = []
+    for scale, stages in current['scales'].items():
+        for stage, result in stages.items():
+            base = baseline['scales'].get(scale, {}).get(stage)
+            if base is None:
+                continue
+            ratio = result['wall_s'] / base['wall_s'] if base['wall_s'] > 0 else 1.0
+            mem_ratio = result['peak_rss_mb'] / base['peak_rss_mb'] if base['peak_rss_mb'] > 0 else 1.0
+            # 実行時間が短い区間は揺らぎが大きいため、min_wall秒未満の区間の時間は比較しない
+            slower = ratio > 1 + args.threshold and max(result['wall_s'], base['wall_s']) >= args.min_wall
+            flag = slower or mem_ratio > 1 + args.threshold
+            print(f'{"REGRESSION" if flag else "ok":>10}  {scale:>9} rows  {stage:<14} '
+                  f'time x{ratio:.2f}  peak RSS x{mem_ratio:.2f}')
+            if flag:
+                regressions.append((scale, stage))
+
+    if regressions:
+        print(f'[benchmark] {len(regressions)} regressions (threshold {args.threshold:.0%})')
+        sys.exit(1)
+    print('[benchmark] no regressions')
+
+
+def main():
+    # 引数の解析
+    parser = argparse.ArgumentParser(description='前処理・特徴量・学習・予測のベンチマーク')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='合成データでベンチマークを実行')
+    run_parser.add_argument('--scales', type=int, nargs='+', default=[1_000, 100_000])
+    run_parser.add_argument('--num-boost-round', type=int, default=100)
+    run_parser.add_argument('--n-splits', type=int, default=5)
+    run_parser.add_argument('--history', type=str, default='data/output/benchmark_history.jsonl')
+    run_parser.add_argument('--save-baseline', type=str, default=None, help='結果をベースラインとして保存')
+
+    compare_parser = subparsers.add_parser('compare', help='最新結果をベースラインと比較')
+    compare_parser.add_argument('--baseline', type=str, required=True)
+    compare_parser.add_argument('--history', type=str, default='data/output/benchmark_history.jsonl')
+    compare_parser.add_argument('--threshold', type=float, default=0.2, help='許容する悪化率')
+    compare_parser.add_argument('--min-wall', type=float, default=0.1,
+                                help='実行時間を比較する区間の最小の実行時間（秒）')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_benchmarks(args)
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
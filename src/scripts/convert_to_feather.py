@@ -6,23 +6,28 @@ from pathlib import Path
 
 import pandas as pd
 
+from preprocessing import CSV_COLUMN_TYPES
+from utils.data_utils import iter_csv_batches, write_batches
 
-def convert_to_feather():
+
+def convert_to_feather(streaming=False, block_size=1 << 24):
     # データディレクトリの設定
     data_dir = Path('data/input')
 
-    # 訓練データの変換
-    train = pd.read_csv(data_dir / 'train.csv')
-    train.to_feather(data_dir / 'train.ftr')
-
-    # テストデータの変換
-    test = pd.read_csv(data_dir / 'test.csv')
-    test.to_feather(data_dir / 'test.ftr')
-
-    # サンプル提出ファイルの変換
-    sample_submission = pd.read_csv(data_dir / 'sample_submission.csv')
-    sample_submission.to_feather(data_dir / 'sample_submission.ftr')
+    for name in ['train', 'test', 'sample_submission']:
+        if streaming:
+            # バッチごとに読み込んで逐次書き込む（ピークメモリはバッチサイズ程度）
+            # 先頭バッチで空の列も型推論に頼らないよう、列の型は前処理と同じものを指定する
+            batches = iter_csv_batches(data_dir / f'{name}.csv', block_size, CSV_COLUMN_TYPES)
+            write_batches(batches, data_dir / f'{name}.ftr')
+        else:
+            df = pd.read_csv(data_dir / f'{name}.csv')
+            df.to_feather(data_dir / f'{name}.ftr')
 
 
 if __name__ == '__main__':
-    convert_to_feather()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streaming', action='store_true', help='CSVをバッチごとに変換')
+    parser.add_argument('--block-size', type=int, default=1 << 24, help='1バッチあたりの読み込みバイト数')
+    args = parser.parse_args()
+    convert_to_feather(args.streaming, args.block_size)
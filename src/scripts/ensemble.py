@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import copy
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from features.loader import load_feature_matrix
+from models.ensemble import (
+    clear_prediction_key, cross_validate, has_predictions, load_predictions, oof_score, prediction_key,
+    save_prediction_key, save_predictions, stack, weighted_vote
+)
+from run import create_submission, get_folds, split_resources, train_and_evaluate
+from utils.logger import setup_logger
+
+# ensemble.methodsで指定できる手法
+ENSEMBLE_METHODS = ('voting', 'stacking')
+
+# メタモデルの既定（ベースモデルの予測確率を入力とするロジスティック回帰）
+DEFAULT_META_MODEL = {'name': 'meta_logistic_regression', 'type': 'sklearn',
+                      'estimator': 'logistic_regression', 'params': {'C': 1.0}}
+
+
+def resolve_model_config(entry):
+    """ensemble.modelsの1要素をモデル設定にする（configキーがあればそのJSONのmodelを使う）"""
+    if 'config' in entry:
+        with open(entry['config']) as f:
+            model_config = json.load(f)['model']
+        return {**model_config, **{k: v for k, v in entry.items() if k != 'config'}}
+    return dict(entry)
+
+
+def get_oof_dir(config):
+    return Path(config['data'].get('oof_dir', 'data/output/oof'))
+
+
+# ワーカープロセスごとに1回だけ受け取る学習データ
+_worker_data = {}
+
+
+def _init_worker(config, data, folds):
+    _worker_data.update(config=config, data=data, folds=folds)
+
+
+def train_base_model(model_config, num_threads=None, config=None, data=None, folds=None):
+    """ベースモデルを共通のフォールドで学習し、OOF予測・テスト予測を保存してCVスコアを返す
+
+    LightGBMはrun.pyの学習（ビン化済みDatasetの再利用）を使い、それ以外はcross_validateで学習する。
+    configを省略した場合はワーカープロセスに渡されたデータを使う。
+    """
+    logger = logging.getLogger(__name__)
+    if config is None:
+        config, data, folds = _worker_data['config'], _worker_data['data'], _worker_data['folds']
+
+    name = model_config['name']
+    logger.info(f'Training base model {name}...')
+    if model_config.get('type', 'lightgbm') == 'lightgbm':
+        model_config = copy.deepcopy(model_config)
+        if num_threads is not None:
+            model_config['params']['num_threads'] = num_threads
+        _, _, cv_score = train_and_evaluate({**config, 'model': model_config}, data, folds=folds)
+    else:
+        oof_preds, fold_test_preds, scores = cross_validate(
+            model_config, folds, data.X_train, data.y_train, data.X_test
+        )
+        save_predictions(get_oof_dir(config), name, oof_preds, fold_test_preds)
+        cv_score = float(np.mean(scores))
+    logger.info(f'Base model {name} CV score: {cv_score:.4f}')
+    return name, cv_score
+
+
+def train_base_models(config, model_configs, data, folds, n_jobs=1):
+    """ベースモデルを順に、またはn_jobs > 1ならプロセスプールで並列に学習"""
+    logger = logging.getLogger(__name__)
+    if n_jobs > 1 and len(model_configs) > 1:
+        n_workers, num_threads = split_resources(n_jobs, len(model_configs))
+        logger.info(f'Training {len(model_configs)} base models with {n_workers} workers '
+                    f'({num_threads} threads each)')
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(config, data, folds)) as executor:
+            futures = [executor.submit(train_base_model, model_config, num_threads)
+                       for model_config in model_configs]
+            return [future.result() for future in futures]
+    return [train_base_model(model_config, config=config, data=data, folds=folds)
+            for model_config in model_configs]
+
+
+def main():
+    # 引数の解析
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/default.json')
+    parser.add_argument('--experiment', type=str, default='configs/experiment.yaml')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='並列に学習するベースモデル数')
+    parser.add_argument('--retrain', action='store_true', help='保存済みのOOF予測があってもベースモデルを再学習')
+    args = parser.parse_args()
+
+    # ロガーの設定
+    logger = setup_logger(__name__)
+
+    # 設定の読み込み
+    with open(args.config) as f:
+        config = json.load(f)
+    with open(args.experiment) as f:
+        ensemble = yaml.safe_load(f)['ensemble']
+    methods = ensemble.get('methods', list(ENSEMBLE_METHODS))
+    unknown = [method for method in methods if method not in ENSEMBLE_METHODS]
+    if unknown:
+        raise ValueError(f'unsupported ensemble methods: {unknown} (choose from {ENSEMBLE_METHODS})')
+    model_configs = [resolve_model_config(entry) for entry in ensemble.get('models', [{'config': args.config}])]
+    names = [model_config['name'] for model_config in model_configs]
+
+    # データと共通のフォールド
+    data = load_feature_matrix(['titanic_features'], columns=config.get('features'), feature_dir='data/output')
+    folds = get_folds(config, data.y_train, data.train_keys)
+
+    # ベースモデル（モデル設定・特徴量・フォールド・データが同じ保存済みの予測があれば再学習しない）
+    oof_dir = get_oof_dir(config)
+    keys = {
+        model_config['name']: prediction_key(model_config, data.feature_names, folds,
+                                             data.X_train, data.y_train, data.X_test)
+        for model_config in model_configs
+    }
+    missing = [
+        model_config for model_config in model_configs
+        if args.retrain or not has_predictions(oof_dir, model_config['name'], keys[model_config['name']])
+    ]
+    if missing:
+        for model_config in missing:
+            clear_prediction_key(oof_dir, model_config['name'])
+        train_base_models(config, missing, data, folds, args.jobs)
+        for model_config in missing:
+            save_prediction_key(oof_dir, model_config['name'], keys[model_config['name']])
+    reused = [name for name in names if name not in {model_config['name'] for model_config in missing}]
+    if reused:
+        logger.info(f'Reusing saved OOF predictions: {reused}')
+
+    # レベル2（ベースモデルの予測を列に並べた行列で学習・推論）
+    oof_preds, test_preds = load_predictions(oof_dir, names)
+    for name, column in zip(names, oof_preds.T):
+        logger.info(f'{name} OOF score: {oof_score(data.y_train, column):.4f}')
+
+    results = {}
+    for method in methods:
+        if method == 'voting':
+            ensemble_oof = weighted_vote(oof_preds, ensemble.get('weights'))
+            ensemble_test = weighted_vote(test_preds, ensemble.get('weights'))
+        else:
+            meta_config = ensemble.get('meta_model', DEFAULT_META_MODEL)
+            ensemble_oof, ensemble_test = stack(meta_config, folds, oof_preds, data.y_train, test_preds)
+        results[method] = (oof_score(data.y_train, ensemble_oof), ensemble_test)
+        logger.info(f'{method} OOF score: {results[method][0]:.4f}')
+
+    # 提出ファイルの作成（既定は最後の手法）
+    submit = ensemble.get('submit', methods[-1])
+    logger.info(f'Submitting {submit} predictions')
+    create_submission(config, data.test_keys, results[submit][1])
+
+    logger.info('Done!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+
+async def _post(reader, writer, host, body):
+    request = (
+        f'POST /predict HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n\r\n'
+    ).encode() + body
+    writer.write(request)
+    await writer.drain()
+    status = await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        if key.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status.split()[1] == b'200'
+
+
+async def _client(host, port, bodies, n_requests, latencies, errors):
+    """1本のkeep-alive接続で順にリクエストを送る"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for i in range(n_requests):
+            t0 = time.perf_counter()
+            ok = await _post(reader, writer, host, bodies[i % len(bodies)])
+            latencies.append(time.perf_counter() - t0)
+            if not ok:
+                errors.append(i)
+    finally:
+        writer.close()
+
+
+async def run(args):
+    # 送信する行をJSONに変換しておく（NaNはnullにする）
+    df = pd.read_csv(args.input)
+    df = df.astype(object).where(df.notna(), None)
+    bodies = [json.dumps(row).encode() for row in df.to_dict(orient='records')]
+
+    # リクエスト数を接続に配分（余りは先頭の接続に1件ずつ足す）
+    base, remainder = divmod(args.requests, args.concurrency)
+    counts = [base + (i < remainder) for i in range(args.concurrency)]
+
+    latencies, errors = [], []
+    t0 = time.perf_counter()
+    await asyncio.gather(*[
+        _client(args.host, args.port, bodies[i::args.concurrency] or bodies, n_requests, latencies, errors)
+        for i, n_requests in enumerate(counts) if n_requests
+    ])
+    elapsed = time.perf_counter() - t0
+
+    latencies = np.array(latencies) * 1000
+    print(json.dumps({
+        'requests': len(latencies),
+        'errors': len(errors),
+        'concurrency': args.concurrency,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'throughput_rps': len(latencies) / elapsed,
+    }, indent=2))
+
+
+def main():
+    # 引数の解析
+    parser = argparse.ArgumentParser(description='serve.pyに同時リクエストを送り、レイテンシとスループットを計測')
+    parser.add_argument('--input', type=str, default='data/input/test.csv', help='送信する行のCSV')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--concurrency', '-c', type=int, default=64, help='同時接続数')
+    parser.add_argument('--requests', '-n', type=int, default=10000, help='総リクエスト数')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
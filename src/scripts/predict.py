@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# 起動を速くするため、推論に必要なモジュールだけを読み込む
+# （matplotlib・wandb・学習用スクリプトやmodelsのsklearnモデル・アンサンブルはimportしない。
+# sklearnはインストールされていればlightgbmが読み込む）
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from features.loader import to_matrix
+from models.lgbm import LGBMModel
+from preprocessing import PreprocessingPipeline
+from utils.logger import setup_logger
+
+
+def read_input(path):
+    """CSV/Feather/Parquetの入力を読み込む"""
+    path = Path(path)
+    if path.suffix == '.csv':
+        return pd.read_csv(path)
+    if path.suffix in ('.ftr', '.feather'):
+        return pd.read_feather(path)
+    if path.suffix == '.parquet':
+        return pd.read_parquet(path)
+    raise ValueError(f'unsupported input format: {path.suffix}')
+
+
+class Predictor:
+    """保存済みの前処理とフォールドモデルを1回だけ読み込んで予測する"""
+
+    def __init__(self, artifact_dir='data/output/artifacts'):
+        artifact_dir = Path(artifact_dir)
+        self.pipeline = PreprocessingPipeline.load(artifact_dir / 'preprocessing_state.json')
+        self.model = LGBMModel.load(artifact_dir)
+        # 学習データから求めたカテゴリ列のカテゴリ（推論データからは求めない）
+        categories_path = artifact_dir / 'feature_categories.json'
+        self.categories = json.loads(categories_path.read_text()) if categories_path.exists() else {}
+
+    def predict(self, df, preprocessed=False):
+        """生データ（preprocessed=Trueなら前処理済みデータ）から予測確率を返す
+
+        学習時（run.py）と同じくfloat32のC連続行列にしてから予測する。
+        カテゴリ列は学習時のカテゴリでコードにする（学習データに現れなかった値は欠損）。
+        """
+        features = df if preprocessed else self.pipeline.transform(df)
+        return self.model.predict(to_matrix(features, self.model.feature_names, np.float32, self.categories))
+
+
+def main():
+    # 引数の解析
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', type=str, help='予測対象のCSV/Feather/Parquet')
+    parser.add_argument('--artifact-dir', type=str, default='data/output/artifacts')
+    parser.add_argument('--output', '-o', type=str, default='data/output/submission.csv')
+    parser.add_argument('--preprocessed', action='store_true', help='入力が前処理済みの場合に指定')
+    parser.add_argument('--proba', action='store_true', help='予測確率を出力')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    args = parser.parse_args()
+
+    # ロガーの設定
+    logger = setup_logger(__name__)
+
+    t0 = time.perf_counter()
+    predictor = Predictor(args.artifact_dir)
+    df = read_input(args.input)
+    t1 = time.perf_counter()
+    preds = predictor.predict(df, args.preprocessed)
+    t2 = time.perf_counter()
+
+    submission = pd.DataFrame({
+        'PassengerId': df['PassengerId'],
+        'Survived': preds if args.proba else (preds > args.threshold).astype(int)
+    })
+    submission.to_csv(args.output, index=False)
+    logger.info(f'Scored {len(df)} rows (load {t1 - t0:.2f} s, predict {t2 - t1:.2f} s)')
+    logger.info(f'Predictions saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
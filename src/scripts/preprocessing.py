@@ -5,38 +5,241 @@ import pandas as pd
 import numpy as np
 from pathlib import Path
 import json
-from datetime import datetime
 import logging
 import pyarrow as pa
-import pyarrow.feather as feather
+import yaml
+
+from utils.encoding import CategoricalEncoder, extract_title
+from utils.data_utils import (
+    StreamingSummary, file_hash, iter_csv_batches, write_batches, write_feather_if_changed, write_json_if_changed
+)
 
 logger = logging.getLogger(__name__)
 
+# ストリーミング読み込み時の列の型（先頭バッチからの型推論に頼らない）
+CSV_COLUMN_TYPES = {
+    'Name': pa.string(),
+    'Sex': pa.string(),
+    'Age': pa.float64(),
+    'Ticket': pa.string(),
+    'Fare': pa.float64(),
+    'Cabin': pa.string(),
+    'Embarked': pa.string(),
+}
+
+
+class PreprocessingPipeline:
+    """学習データでfitした統計量をtrain/test/推論データに共通して適用する前処理
+
+    fitで補完値・スケーリング統計量を1回だけ計算し、transformは列ごとに
+    1パスで変換して最後にDataFrameを1回だけ組み立てる。fit済みの状態は
+    JSONとして保存・復元できる。
+    """
+
+    def __init__(self, config, preprocessing=None):
+        """
+        Args:
+            config (dict): カテゴリのマッピング・敬称の置換設定
+            preprocessing (dict, optional): configs/data.yamlの`preprocessing`セクション. Defaults to None.
+        """
+        self.config = config
+        self.preprocessing = preprocessing or {}
+        self.state = None
+        self._encoders = None
+
+        encoding = self.preprocessing.get('encoding', {}).get('categorical', 'label')
+        if encoding != 'label':
+            raise ValueError(f'unsupported categorical encoding: {encoding}')
+        scaling = self.preprocessing.get('scaling', {}).get('method')
+        if scaling not in (None, 'standard'):
+            raise ValueError(f'unsupported scaling method: {scaling}')
+
+    def _get_encoders(self):
+        """カテゴリ変換のルックアップ表（configとfit済みの敬称表から1回だけ作る）"""
+        if self._encoders is None:
+            mappings = self.config['categorical_mappings']
+            self._encoders = {
+                'Sex': CategoricalEncoder(mappings['Sex']),
+                'Embarked': CategoricalEncoder(mappings['Embarked']),
+                'Title': CategoricalEncoder(self.state['title_lookup'], default=0),
+            }
+        return self._encoders
+
+    def _fill_value(self, series, strategy):
+        if strategy == 'median':
+            return float(series.median())
+        if strategy == 'mean':
+            return float(series.mean())
+        if strategy == 'mode':
+            return series.mode()[0]
+        raise ValueError(f'unsupported missing value strategy: {strategy}')
+
+    def _strategies(self):
+        missing = self.preprocessing.get('missing_values', {})
+        return missing.get('strategy', 'median'), missing.get('categorical_fill', 'mode')
+
+    def _scaling_features(self):
+        scaling = self.preprocessing.get('scaling', {})
+        return scaling.get('features', []) if scaling.get('method') == 'standard' else []
+
+    def _init_state(self, fill):
+        self.state = {
+            'fill': fill,
+            # 希少敬称の集約・置換・ラベル化をまとめた表（推論時は保存した表を使う）
+            'title_lookup': CategoricalEncoder.for_titles(self.config).lookup,
+            'scaling': {},
+        }
+        self._encoders = None
+
+    def _set_scaling(self, col, mean, std):
+        self.state['scaling'][col] = {'mean': float(mean), 'std': float(std) if std > 0 else 1.0}
+
+    def fit(self, df):
+        """学習データから補完値とスケーリング統計量を計算"""
+        numeric_strategy, categorical_strategy = self._strategies()
+        self._init_state({
+            'Age': self._fill_value(df['Age'], numeric_strategy),
+            'Fare': self._fill_value(df['Fare'], numeric_strategy),
+            'Embarked': self._fill_value(df['Embarked'], categorical_strategy),
+        })
+
+        scaling_features = self._scaling_features()
+        if scaling_features:
+            columns = self._transform_columns(df)
+            for col in scaling_features:
+                values = columns[col].astype(np.float64)
+                self._set_scaling(col, values.mean(), values.std())
+        return self
+
+    def fit_batches(self, batches, sample_size=100_000):
+        """バッチ単位で学習データを読みながらfitする（全データをメモリに載せない）
+
+        1パス目で補完値を、スケーリングが有効な場合は2パス目でスケーリング統計量を
+        計算する。中央値はリザーバサンプリングによる近似値、最頻値は厳密値。
+
+        Args:
+            batches (callable): 呼び出すたびに先頭からDataFrameのバッチを返す関数
+            sample_size (int, optional): 中央値計算用のサンプル数. Defaults to 100_000.
+        """
+        numeric_strategy, categorical_strategy = self._strategies()
+        if categorical_strategy != 'mode':
+            raise ValueError(f'unsupported missing value strategy: {categorical_strategy}')
+
+        summaries = {col: StreamingSummary(sample_size) for col in ['Age', 'Fare']}
+        embarked_counts = pd.Series(dtype=np.float64)
+        for df in batches():
+            for col, summary in summaries.items():
+                summary.update(df[col])
+            embarked_counts = embarked_counts.add(df['Embarked'].value_counts(), fill_value=0)
+
+        fill = {}
+        for col, summary in summaries.items():
+            if numeric_strategy == 'median':
+                fill[col] = summary.median()
+            elif numeric_strategy == 'mean':
+                fill[col] = float(summary.mean)
+            else:
+                raise ValueError(f'unsupported missing value strategy: {numeric_strategy}')
+        # pandasのmodeと同様に、同数の場合は最小の値を選ぶ
+        fill['Embarked'] = min(embarked_counts[embarked_counts == embarked_counts.max()].index)
+        self._init_state(fill)
+
+        scaling_features = self._scaling_features()
+        if scaling_features:
+            summaries = {col: StreamingSummary(sample_size=0) for col in scaling_features}
+            for df in batches():
+                columns = self._transform_columns(df)
+                for col, summary in summaries.items():
+                    summary.update(columns[col])
+            for col, summary in summaries.items():
+                self._set_scaling(col, summary.mean, summary.std())
+        return self
+
+    def _transform_columns(self, df):
+        """スケーリング前の変換結果を列ごとに計算"""
+        fill = self.state['fill']
+        encoders = self._get_encoders()
+
+        family_size = df['SibSp'] + df['Parch'] + 1
+
+        return {
+            'PassengerId': df['PassengerId'],
+            'Pclass': df['Pclass'],
+            'Sex': encoders['Sex'].transform(df['Sex']),
+            'Age': df['Age'].fillna(fill['Age']),
+            'Fare': df['Fare'].fillna(fill['Fare']),
+            'Embarked': encoders['Embarked'].transform(df['Embarked'], fill_value=fill['Embarked']),
+            'FamilySize': family_size,
+            'IsAlone': (family_size == 1).astype(int),
+            # 敬称の抽出・置換・希少敬称の集約・ラベル化をArrowで1パスずつ行う
+            'Title': encoders['Title'].transform(extract_title(df['Name'])),
+        }
+
+    def transform(self, df):
+        """fit済みの状態で前処理を適用"""
+        if self.state is None:
+            raise RuntimeError('PreprocessingPipeline is not fitted')
+
+        columns = self._transform_columns(df)
+        for col, params in self.state['scaling'].items():
+            columns[col] = (columns[col] - params['mean']) / params['std']
+        if 'Survived' in df.columns:
+            columns['Survived'] = df['Survived']
+        return pd.DataFrame(columns, index=df.index)
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def save(self, path, outputs=None):
+        """fit済みの状態をJSONで保存
+
+        Args:
+            path (str or Path): 保存先
+            outputs (dict, optional): この状態で変換して書き込んだファイル名→内容のハッシュ. Defaults to None.
+        """
+        saved = {'config': self.config, 'preprocessing': self.preprocessing, 'state': self.state}
+        if outputs is not None:
+            saved['outputs'] = outputs
+        write_json_if_changed(saved, path)
+
+    @classmethod
+    def load(cls, path):
+        """保存済みの状態から復元"""
+        with open(path) as f:
+            saved = json.load(f)
+        pipeline = cls(saved['config'], saved['preprocessing'])
+        pipeline.state = saved['state']
+        return pipeline
+
+
+def check_state_outputs(state_path, output_dir):
+    """保存済みの前処理の状態が、output_dirにあるファイルを書き込んだときのものか確認する
+
+    別の処理（特徴量生成など）がファイルを上書きした場合や、状態が古い場合はValueErrorを送出する。
+    """
+    with open(state_path) as f:
+        outputs = json.load(f).get('outputs')
+    if not outputs:
+        raise ValueError(f'{state_path} does not record its output files, run preprocessing again')
+    changed = [filename for filename, content_hash in outputs.items()
+               if not (Path(output_dir) / filename).exists()
+               or file_hash(Path(output_dir) / filename) != content_hash]
+    if changed:
+        raise ValueError(f'{changed} were not written with {state_path}, run preprocessing again')
+
+
 class TitanicPreprocessor:
-    def __init__(self, input_dir='data/input', output_dir='data/output'):
+    def __init__(self, input_dir='data/input', output_dir='data/output', data_config='configs/data.yaml'):
         self.input_dir = Path(input_dir)
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.pipeline = None
 
-        # 前処理の設定
-        self.config = {
-            'categorical_mappings': {
-                'Sex': {'male': 0, 'female': 1},
-                'Embarked': {'C': 0, 'Q': 1, 'S': 2},
-                'Title': {
-                    'Mr': 1, 'Miss': 2, 'Mrs': 3, 'Master': 4, 'Rare': 5
-                }
-            },
-            'rare_titles': [
-                'Lady', 'Countess', 'Capt', 'Col', 'Don', 'Dr',
-                'Major', 'Rev', 'Sir', 'Jonkheer', 'Dona'
-            ],
-            'title_replacements': {
-                'Mlle': 'Miss',
-                'Ms': 'Miss',
-                'Mme': 'Mrs'
-            }
-        }
+        # configs/data.yamlのカテゴリのマッピング（mappings）と前処理設定（preprocessing）
+        with open(data_config) as f:
+            data_settings = yaml.safe_load(f) or {}
+        self.config = data_settings['mappings']
+        self.preprocessing = data_settings.get('preprocessing', {})
 
         # 前処理の統計情報を保存
         self.stats = {
@@ -45,95 +248,100 @@ class TitanicPreprocessor:
         }
 
     def preprocess(self, force=False):
-        """前処理を実行し、結果を保存"""
+        """前処理を実行し、結果を保存
+
+        各成果物は1回だけ書き込み、内容が前回から変わっていなければ書き込みを省略する
+        （force=Trueなら常に書き込む）。
+        """
         # 元データの読み込み
         train = pd.read_csv(self.input_dir / 'train.csv')
         test = pd.read_csv(self.input_dir / 'test.csv')
 
-        # 元データの保存
-        train.to_csv(self.output_dir / 'raw_train.csv', index=False)
-        test.to_csv(self.output_dir / 'raw_test.csv', index=False)
-        logger.info('Saved raw data')
+        # 元データのスナップショット（CSVのコピーではなくFeather形式）
+        self._save_feather(train, 'raw_train.ftr', force)
+        self._save_feather(test, 'raw_test.ftr', force)
 
-        # 前処理の実行
-        train_processed = self._process_data(train, 'train')
-        test_processed = self._process_data(test, 'test')
+        # 前処理の実行（統計量は学習データのみでfit）
+        self.pipeline = PreprocessingPipeline(self.config, self.preprocessing).fit(train)
+        train_processed = self.pipeline.transform(train)
+        test_processed = self.pipeline.transform(test)
+        self._collect_stats(train_processed, 'train')
+        self._collect_stats(test_processed, 'test')
 
         # 前処理済みデータの保存（Feather形式）
-        self._save_feather(train_processed, 'titanic_features_train.ftr')
-        self._save_feather(test_processed, 'titanic_features_test.ftr')
-        logger.info('Saved processed data')
+        self._save_feather(train_processed, 'titanic_features_train.ftr', force)
+        self._save_feather(test_processed, 'titanic_features_test.ftr', force)
+        self._save_state(['titanic_features_train.ftr', 'titanic_features_test.ftr'])
 
         # 前処理の統計情報を保存
-        self._save_stats()
+        self._save_stats(force)
 
         return train_processed, test_processed
 
-    def _save_feather(self, df, filename):
-        """Feather形式でデータを保存"""
-        # データ型の最適化
-        df = df.copy()
-        for col in df.select_dtypes(include=['object']).columns:
-            df[col] = df[col].astype('category')
-
-        # Feather形式で保存
-        feather.write_feather(df, self.output_dir / filename, compression='lz4')
-        logger.info(f'Saved {filename}')
-
-    def _process_data(self, df, dataset_name):
-        """データの前処理を実行"""
-        df = df.copy()
-
-        # 性別の変換
-        df['Sex'] = df['Sex'].map(self.config['categorical_mappings']['Sex'])
-        self.stats[dataset_name]['sex_mapping'] = dict(df['Sex'].value_counts())
-
-        # 年齢の欠損値補完
-        age_median = df['Age'].median()
-        df['Age'] = df['Age'].fillna(age_median)
-        self.stats[dataset_name]['age_median'] = age_median
-        self.stats[dataset_name]['age_missing'] = df['Age'].isnull().sum()
-
-        # 運賃の欠損値補完
-        fare_median = df['Fare'].median()
-        df['Fare'] = df['Fare'].fillna(fare_median)
-        self.stats[dataset_name]['fare_median'] = fare_median
-        self.stats[dataset_name]['fare_missing'] = df['Fare'].isnull().sum()
-
-        # 乗船港の欠損値補完
-        embarked_mode = df['Embarked'].mode()[0]
-        df['Embarked'] = df['Embarked'].fillna(embarked_mode)
-        df['Embarked'] = df['Embarked'].map(self.config['categorical_mappings']['Embarked'])
-        self.stats[dataset_name]['embarked_mode'] = embarked_mode
-        self.stats[dataset_name]['embarked_missing'] = df['Embarked'].isnull().sum()
-
-        # 家族サイズの特徴量
-        df['FamilySize'] = df['SibSp'] + df['Parch'] + 1
-        self.stats[dataset_name]['family_size_stats'] = {
+    def preprocess_streaming(self, block_size=1 << 24, file_format='feather'):
+        """CSVをバッチごとに読み込んで前処理し、結果を逐次書き込む
+
+        ピークメモリはバッチサイズで決まるため、メモリに載らない入力にも使える。
+
+        Args:
+            block_size (int, optional): 1バッチあたりの読み込みバイト数. Defaults to 16MB.
+            file_format (str, optional): 'feather' または 'parquet'. Defaults to 'feather'.
+
+        Returns:
+            tuple: (train, test) の出力ファイルパス
+        """
+        extension = 'ftr' if file_format == 'feather' else 'parquet'
+
+        def batches(name):
+            return iter_csv_batches(self.input_dir / f'{name}.csv', block_size, CSV_COLUMN_TYPES)
+
+        self.pipeline = PreprocessingPipeline(self.config, self.preprocessing)
+        self.pipeline.fit_batches(lambda: batches('train'))
+
+        paths = []
+        for name in ['train', 'test']:
+            path = self.output_dir / f'titanic_features_{name}.{extension}'
+            n_rows = write_batches((self.pipeline.transform(df) for df in batches(name)), path, file_format)
+            self.stats[name]['fill_values'] = self.pipeline.state['fill']
+            self.stats[name]['scaling'] = self.pipeline.state['scaling']
+            self.stats[name]['n_rows'] = n_rows
+            logger.info(f'Saved {path.name} ({n_rows} rows)')
+            paths.append(path)
+
+        self._save_state([path.name for path in paths])
+        self._save_stats()
+        return tuple(paths)
+
+    def _save_state(self, filenames):
+        """fit済みの状態を、変換して書き込んだファイルのハッシュとともに保存"""
+        outputs = {filename: file_hash(self.output_dir / filename) for filename in filenames}
+        self.pipeline.save(self.output_dir / 'preprocessing_state.json', outputs)
+
+    def _save_feather(self, df, filename, force=False):
+        """Feather形式でデータを保存（内容が変わっていなければ省略）
+
+        列の型は値を表現できる最小の型に縮小して保存する（元の型はファイルに記録される）。
+        """
+        if write_feather_if_changed(df, self.output_dir / filename, force):
+            logger.info(f'Saved {filename}')
+        else:
+            logger.info(f'{filename} is unchanged, skipped writing')
+
+    def _collect_stats(self, df, dataset_name):
+        """前処理結果とfit済みの統計量を記録"""
+        stats = self.stats[dataset_name]
+        stats['fill_values'] = self.pipeline.state['fill']
+        stats['scaling'] = self.pipeline.state['scaling']
+        stats['sex_mapping'] = dict(df['Sex'].value_counts())
+        stats['embarked_missing'] = df['Embarked'].isnull().sum()
+        stats['family_size_stats'] = {
             'mean': df['FamilySize'].mean(),
             'std': df['FamilySize'].std(),
             'min': df['FamilySize'].min(),
             'max': df['FamilySize'].max()
         }
-
-        # 単独旅行者かどうか
-        df['IsAlone'] = (df['FamilySize'] == 1).astype(int)
-        self.stats[dataset_name]['is_alone_ratio'] = df['IsAlone'].mean()
-
-        # 名前から敬称を抽出
-        df['Title'] = df['Name'].str.extract(' ([A-Za-z]+)\.', expand=False)
-        df['Title'] = df['Title'].replace(self.config['rare_titles'], 'Rare')
-        df['Title'] = df['Title'].replace(self.config['title_replacements'])
-        df['Title'] = df['Title'].map(self.config['categorical_mappings']['Title'])
-        df['Title'] = df['Title'].fillna(0)
-        self.stats[dataset_name]['title_distribution'] = dict(df['Title'].value_counts())
-
-        # 必要なカラムのみを残す
-        keep_cols = ['PassengerId', 'Pclass', 'Sex', 'Age', 'Fare', 'Embarked', 'FamilySize', 'IsAlone', 'Title']
-        if 'Survived' in df.columns:
-            keep_cols.append('Survived')
-        df = df[keep_cols]
-        return df
+        stats['is_alone_ratio'] = df['IsAlone'].mean()
+        stats['title_distribution'] = dict(df['Title'].value_counts())
 
     def _convert_to_serializable(self, obj):
         """numpyの数値型をPythonの標準型に変換"""
@@ -149,15 +357,12 @@ class TitanicPreprocessor:
             return [self._convert_to_serializable(item) for item in obj]
         return obj
 
-    def _save_stats(self):
-        """前処理の統計情報を保存"""
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        stats_file = self.output_dir / f'preprocessing_stats_{timestamp}.json'
+    def _save_stats(self, force=False):
+        """前処理の統計情報を保存（実行ごとにファイルを増やさず上書きする）"""
+        stats_file = self.output_dir / 'preprocessing_stats.json'
 
         # numpyの数値型をPythonの標準型に変換
         serializable_stats = self._convert_to_serializable(self.stats)
 
-        with open(stats_file, 'w') as f:
-            json.dump(serializable_stats, f, indent=2)
-
-        logger.info(f'Saved preprocessing statistics to {stats_file}')
\ No newline at end of file
+        if write_json_if_changed(serializable_stats, stats_file, force):
+            logger.info(f'Saved preprocessing statistics to {stats_file}')
\ No newline at end of file
@@ -2,18 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import copy
 import json
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import lightgbm as lgb
 import pandas as pd
 import numpy as np
-from sklearn.model_selection import KFold
 from sklearn.metrics import accuracy_score, roc_auc_score
 
 from preprocessing import TitanicPreprocessor
-from models.lgbm import LGBMModel
+from models.ensemble import clear_prediction_key
+from models.lgbm import LGBMModel, DatasetCache
+from models.splitter import GROUP_STRATEGIES, FoldCache
+from features.loader import load_feature_matrix, make_feature_matrix
 from utils.logger import setup_logger
+from utils.tracing import configure_tracer, get_tracer, span
+from utils.wandb_utils import (
+    finish_wandb, init_wandb, is_tracking, lightgbm_callback, log_artifact, log_evaluation_history, log_metrics
+)
 
 
 def preprocess_data(config, force=False):
@@ -27,64 +37,264 @@ def preprocess_data(config, force=False):
     return train, test
 
 
-def train_and_evaluate(config, train, test):
-    """モデルの学習と評価を実行"""
+def preprocess_streaming(config, block_size=1 << 24):
+    """CSVをバッチごとに前処理してファイルへ逐次書き込み、書き込んだファイルから特徴量行列を作る
+
+    前処理済みのDataFrame全体はメモリに載せない（行列はメモリマップしたArrowテーブルから作る）。
+    """
     logger = logging.getLogger(__name__)
+    logger.info('Preprocessing data in batches...')
 
-    # データの準備
-    X_train = train.drop(['Survived', 'PassengerId'], axis=1)
-    y_train = train['Survived']
-    X_test = test.drop(['PassengerId'], axis=1)
+    TitanicPreprocessor().preprocess_streaming(block_size)
+    return load_feature_matrix(['titanic_features'], feature_dir='data/output')
 
-    # クロスバリデーションの設定
-    cv = KFold(n_splits=5, shuffle=True, random_state=42)
-    cv_scores = []
 
-    # クロスバリデーション
-    logger.info('Starting cross-validation...')
-    for fold, (train_idx, val_idx) in enumerate(cv.split(X_train), 1):
-        logger.info(f'Training fold {fold}/5')
+# ワーカープロセスごとに1回だけ受け取る学習データ
+_worker_data = {}
 
-        # データの分割
-        X_tr = X_train.iloc[train_idx]
-        y_tr = y_train.iloc[train_idx]
-        X_val = X_train.iloc[val_idx]
-        y_val = y_train.iloc[val_idx]
 
-        # モデルの学習
-        model = LGBMModel(config['model'])
-        model.train(X_tr, y_tr, X_val, y_val)
+def _init_worker(X_train, y_train, X_test, cache, dataset_path):
+    get_tracer().reset()
+    _worker_data['X_train'] = X_train
+    _worker_data['y_train'] = y_train
+    _worker_data['X_test'] = X_test
+    _worker_data['dataset'] = cache.load(dataset_path)
 
-        # 検証データでの予測
+
+def train_fold(model_config, fold, train_idx, val_idx, X_train=None, y_train=None, X_test=None, dataset=None,
+               callbacks=None):
+    """1フォールド分の学習と検証・テストデータの予測（ビン化済みDatasetから行を選ぶだけで再ビン化しない）
+
+    X_train・y_train・X_testはNumPy配列（FeatureMatrix）。X_trainを省略した場合は
+    ワーカープロセスに渡されたデータを使う。X_testがNoneの場合はテストデータの予測を行わない。
+    """
+    logger = logging.getLogger(__name__)
+    if X_train is None:
+        X_train, y_train = _worker_data['X_train'], _worker_data['y_train']
+        X_test, dataset = _worker_data['X_test'], _worker_data['dataset']
+
+    # データの分割
+    train_set = dataset.subset(train_idx)
+    valid_set = dataset.subset(val_idx)
+    X_val = X_train[val_idx]
+    y_val = y_train[val_idx]
+
+    # モデルの学習
+    model = LGBMModel(model_config)
+    with span('fold_fit', rows=len(train_idx), fold=fold):
+        model.train_dataset(train_set, valid_set, callbacks=callbacks)
+
+    # 検証データ・テストデータでの予測
+    with span('fold_predict', rows=len(val_idx) + (len(X_test) if X_test is not None else 0), fold=fold):
         val_preds = model.predict(X_val)
-        val_score = accuracy_score(y_val, (val_preds > 0.5).astype(int))
-        cv_scores.append(val_score)
+        test_preds = model.predict(X_test) if X_test is not None else None
+    val_score = accuracy_score(y_val, (val_preds > 0.5).astype(int))
+    logger.info(f'Fold {fold} validation score: {val_score:.4f} (best iteration: {model.best_iterations[0]})')
+
+    return fold, model, val_preds, val_score, test_preds
+
+
+def _train_fold_traced(*args, record_history=False):
+    """ワーカープロセスでフォールドを学習し、記録したスパンと各イテレーションの評価値も返す
+
+    ワーカーからは記録キューに送信できないため、評価値はrecord_evaluationで集めて親プロセスで記録する。
+    """
+    tracer = get_tracer()
+    n_events = len(tracer.events)
+    history = {}
+    callbacks = [lgb.record_evaluation(history)] if record_history else None
+    return train_fold(*args, callbacks=callbacks), tracer.events[n_events:], history
+
+
+def split_resources(n_jobs, n_tasks):
+    """並列タスク数と1タスクあたりのLightGBMスレッド数を決める"""
+    n_cores = os.cpu_count() or 1
+    n_workers = max(1, min(n_jobs, n_tasks, n_cores))
+    return n_workers, max(1, n_cores // n_workers)
+
+
+def load_groups(config, keys, key='PassengerId'):
+    """グループ分割用のグループ（元データのtrain.group_column列）をkeysの行順で返す"""
+    train_config = config['model'].get('train', {})
+    column = train_config.get('group_column', 'Ticket')
+    raw = pd.read_csv(config['data']['train'], usecols=[key, column])
+    return raw.set_index(key)[column].reindex(keys).to_numpy()
+
+
+def get_folds(config, y_train, keys=None):
+    """クロスバリデーションのフォールド（番号, 学習index, 検証index）を返す
+
+    分割方法はmodel.trainのcv_strategy・n_splits・random_state・n_repeatsで指定し、
+    フォールドはFoldCacheに保存して、同じデータ・設定なら全モデル・試行で同じものを使う。
+    グループ分割ではkeys（PassengerId）で元データのgroup_column列を引く。
+    """
+    train_config = config['model'].get('train', {})
+    strategy = train_config.get('cv_strategy', 'stratified')
+    groups = load_groups(config, keys) if strategy in GROUP_STRATEGIES else None
+    cache = FoldCache(train_config.get('fold_cache_dir', 'data/processed/folds'))
+    return cache.get(
+        y_train, groups,
+        strategy=strategy,
+        n_splits=train_config.get('n_splits', 5),
+        random_state=train_config.get('random_state', 42),
+        n_repeats=train_config.get('n_repeats', 1),
+    )
+
+
+def get_dataset_cache(config):
+    """設定に従ってビン化済みDatasetのキャッシュを返す"""
+    cache_dir = config['model'].get('train', {}).get('dataset_cache_dir', 'data/processed/lgb_datasets')
+    return DatasetCache(cache_dir, config['model']['params'])
 
-        logger.info(f'Fold {fold} validation score: {val_score:.4f}')
+
+def _open_prediction_store(path, shape):
+    """予測値を書き込むメモリマップ済みの.npyを確保"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=shape)
+
+
+def _save_fold_predictions(config, folds, results, n_train, n_test):
+    """OOF予測とフォールドごとのテスト予測をメモリマップ済みの.npyへ書き込む
+
+    ensemble.pyが記録した再利用判定用のキーは、書き込む予測と一致しなくなるため先に消す。
+    """
+    logger = logging.getLogger(__name__)
+    oof_dir = Path(config['data'].get('oof_dir', 'data/output/oof'))
+    clear_prediction_key(oof_dir, config['model']['name'])
+    oof_preds = _open_prediction_store(oof_dir / f'{config["model"]["name"]}_oof.npy', (n_train,))
+    fold_test_preds = _open_prediction_store(oof_dir / f'{config["model"]["name"]}_test.npy', (len(folds), n_test))
+    # 繰り返しのある分割では各行の検証予測を平均する
+    counts = np.zeros(n_train, dtype=np.int32)
+    for (_, _, val_idx), (fold, _, val_preds, _, test_preds) in zip(folds, results):
+        oof_preds[val_idx] += val_preds
+        counts[val_idx] += 1
+        fold_test_preds[fold - 1] = test_preds
+    oof_preds /= np.maximum(counts, 1)
+    oof_preds.flush()
+    fold_test_preds.flush()
+    logger.info(f'Saved OOF and fold test predictions to {oof_dir}')
+    return fold_test_preds
+
+
+def _cross_validate(config, folds, X_train, y_train, X_test, cache, dataset_path, n_jobs):
+    """フォールドを順に、またはn_jobs > 1ならプロセスプールで並列に学習（結果はフォールド順）"""
+    logger = logging.getLogger(__name__)
+    n_splits = len(folds)
+    num_boost_round = config['model'].get('train', {}).get('num_boost_round', 1000)
+
+    def step_offset(fold):
+        # 記録のstepはフォールドをまたいで単調増加するよう (fold - 1) * num_boost_round + iteration とする
+        return (fold - 1) * num_boost_round
+
+    if n_jobs > 1:
+        n_workers, num_threads = split_resources(n_jobs, n_splits)
+        logger.info(f'Training {n_workers} folds in parallel with {num_threads} threads each')
+        fold_config = copy.deepcopy(config['model'])
+        fold_config['params']['num_threads'] = num_threads
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(X_train, y_train, X_test, cache, dataset_path)) as executor:
+            futures = [
+                executor.submit(_train_fold_traced, fold_config, fold, train_idx, val_idx,
+                                record_history=is_tracking())
+                for fold, train_idx, val_idx in folds
+            ]
+            results = []
+            for (fold, _, _), future in zip(folds, futures):
+                result, events, history = future.result()
+                get_tracer().merge(events)
+                if history:
+                    # ワーカーで記録した評価値をフォールド順に送信（stepはシリアル実行と同じ）
+                    log_evaluation_history(history, f'fold{fold}/', period=10, step_offset=step_offset(fold))
+                results.append(result)
+    else:
+        dataset = cache.load(dataset_path)
+        results = []
+        for fold, train_idx, val_idx in folds:
+            logger.info(f'Training fold {fold}/{n_splits}')
+            # 記録が有効なら各イテレーションの評価値をバックグラウンドで送信
+            callbacks = None
+            if is_tracking():
+                callbacks = [lightgbm_callback(f'fold{fold}/', period=10, step_offset=step_offset(fold))]
+            results.append(train_fold(config['model'], fold, train_idx, val_idx,
+                                      X_train, y_train, X_test, dataset, callbacks))
+    return results
+
+
+def train_and_evaluate(config, data, n_jobs=1, folds=None):
+    """モデルの学習と評価を実行
+
+    dataはFeatureMatrix（float32行列）。フォールドは行indexとしてビン化済みDatasetと
+    行列に渡し、フォールドごとのDataFrameは作らない。
+
+    n_jobs > 1の場合はフォールドをプロセスプールで並列に学習し、
+    コア数をフォールド間とLightGBMのnum_threadsで分け合う。
+    OOF予測とフォールドごとのテスト予測は`{oof_dir}/{model名}_oof.npy`・
+    `{model名}_test.npy`に保存し、テスト予測はフォールドモデルの平均とする。
+    foldsを渡した場合はそのフォールドで学習する（アンサンブルで全モデルに同じフォールドを使う）。
+    train.refit_fullがtrueの場合のみ全データで再学習する。
+    """
+    logger = logging.getLogger(__name__)
+    train_config = config['model'].get('train', {})
+
+    # データの準備
+    X_train, y_train, X_test = data.X_train, data.y_train, data.X_test
+
+    # クロスバリデーションの設定
+    if folds is None:
+        folds = get_folds(config, y_train, data.train_keys)
+    n_splits = len(folds)
+
+    # ビン化済みDatasetを用意（同じ特徴量行列ならフォールド・実験間で再利用）
+    with span('build_dataset', rows=len(X_train)):
+        cache = get_dataset_cache(config)
+        dataset_path = cache.build(X_train, y_train, data.feature_names)
+
+    # クロスバリデーション
+    logger.info('Starting cross-validation...')
+    with span('cv', rows=len(X_train), n_splits=n_splits):
+        results = _cross_validate(config, folds, X_train, y_train, X_test, cache, dataset_path, n_jobs)
+
+    # OOF予測・フォールドごとのテスト予測を保存（結果はフォールド順に並んでいる）
+    with span('save_predictions', rows=len(X_train) + n_splits * len(X_test)):
+        fold_test_preds = _save_fold_predictions(config, folds, results, len(X_train), len(X_test))
 
     # クロスバリデーションスコアの平均
+    cv_scores = [val_score for _, _, _, val_score, _ in results]
     mean_cv_score = np.mean(cv_scores)
     logger.info(f'Mean CV score: {mean_cv_score:.4f}')
+    if is_tracking():
+        log_metrics({**{f'fold{fold}/accuracy': score for fold, _, _, score, _ in results}, 'cv_score': mean_cv_score})
+
+    # フォールドモデルのアンサンブル
+    model = LGBMModel(config['model'])
+    for _, fold_model, _, _, _ in results:
+        model.models.extend(fold_model.models)
+        model.best_iterations.extend(fold_model.best_iterations)
+
+    if train_config.get('refit_full', False):
+        # 全データでの学習（ラウンド数は各フォールドの最良イテレーションの平均）
+        num_boost_round = max(1, int(round(np.mean(model.best_iterations))))
+        logger.info(f'Training final model for {num_boost_round} rounds...')
+        model = LGBMModel(config['model'])
+        with span('refit', rows=len(X_train)):
+            model.train_dataset(cache.load(dataset_path), num_boost_round=num_boost_round)
+        logger.info('Making predictions...')
+        with span('predict', rows=len(X_test)):
+            test_preds = model.predict(X_test)
+    else:
+        # 再学習せず、フォールドごとのテスト予測を平均
+        test_preds = fold_test_preds.mean(axis=0)
 
-    # 全データでの学習
-    logger.info('Training final model...')
-    final_model = LGBMModel(config['model'])
-    final_model.train(X_train, y_train)
-
-    # テストデータでの予測
-    logger.info('Making predictions...')
-    test_preds = final_model.predict(X_test)
-
-    return final_model, test_preds, mean_cv_score
+    return model, test_preds, mean_cv_score
 
 
-def create_submission(config, test, preds):
+def create_submission(config, passenger_ids, preds):
     """提出ファイルの作成"""
     logger = logging.getLogger(__name__)
     logger.info('Creating submission file...')
 
     submission = pd.DataFrame({
-        'PassengerId': test['PassengerId'],
+        'PassengerId': passenger_ids,
         'Survived': (preds > 0.5).astype(int)
     })
 
@@ -98,28 +308,59 @@ def main():
     parser.add_argument('--config', type=str, default='configs/default.json')
     parser.add_argument('--force', '-f', action='store_true')
     parser.add_argument('--skip-preprocess', action='store_true', help='前処理をスキップ')
+    parser.add_argument('--streaming', action='store_true', help='CSVをバッチごとに前処理（メモリに載らない入力用）')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='クロスバリデーションの並列フォールド数')
+    parser.add_argument('--trace', type=str, default='data/output/trace.json', help='Chrome trace形式の出力先')
+    parser.add_argument('--profile', type=str, nargs='*', default=[], help='プロファイルするステージ名（例: fold_fit）')
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile')
+    parser.add_argument('--wandb', action='store_true', help='W&Bに記録する（送信はバックグラウンドで行う）')
     args = parser.parse_args()
 
     # ロガーの設定
     logger = setup_logger(__name__)
+    # LightGBMの学習ログもキュー経由で出力し、イテレーションごとの似たメッセージは間引く
+    lgb.register_logger(setup_logger('lightgbm', rate_limit=1.0))
+    tracer = configure_tracer(profile=args.profile, profiler=args.profiler)
 
     # 設定の読み込み
     with open(args.config) as f:
         config = json.load(f)
+    if args.wandb:
+        init_wandb()
 
     # 前処理
-    if not args.skip_preprocess:
-        train, test = preprocess_data(config, args.force)
+    if args.streaming and not args.skip_preprocess:
+        with span('preprocess') as info:
+            data = preprocess_streaming(config)
+            info['rows'] = len(data.X_train) + len(data.X_test)
+    elif not args.skip_preprocess:
+        with span('preprocess') as info:
+            train, test = preprocess_data(config, args.force)
+            data = make_feature_matrix(train, test)
+            info['rows'] = len(train) + len(test)
+            del train, test
     else:
         logger.info('Loading preprocessed data...')
-        train = pd.read_feather('data/output/titanic_features_train.ftr')
-        test = pd.read_feather('data/output/titanic_features_test.ftr')
+        with span('load') as info:
+            data = load_feature_matrix(
+                ['titanic_features'], columns=config.get('features'), feature_dir='data/output'
+            )
+            info['rows'] = len(data.X_train) + len(data.X_test)
 
     # モデルの学習と評価
-    model, test_preds, cv_score = train_and_evaluate(config, train, test)
+    with span('train_and_evaluate', rows=len(data.X_train)):
+        model, test_preds, cv_score = train_and_evaluate(config, data, args.jobs)
 
     # 提出ファイルの作成
-    create_submission(config, test, test_preds)
+    with span('save', rows=len(data.X_test)):
+        create_submission(config, data.test_keys, test_preds)
+    if args.wandb:
+        log_artifact(config['data']['submission'], 'submission', 'predictions')
+        finish_wandb()
+
+    # 計測結果の出力
+    tracer.write_chrome_trace(args.trace)
+    logger.info(f'Stage summary (trace: {args.trace}):\n{tracer.summary()}')
 
     logger.info('Done!')
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from predict import Predictor
+from utils.logger import setup_logger
+
+# JSONのnullだけの列がobject型にならないよう数値に揃える入力列
+NUMERIC_COLUMNS = ['PassengerId', 'Pclass', 'Age', 'SibSp', 'Parch', 'Fare']
+
+
+class MicroBatcher:
+    """同時に届いた1行ずつのリクエストをまとめて、ベクトル化された予測を1回で行う
+
+    キューに最初のリクエストが届いてから最大max_wait秒、またはmax_batch_size件に
+    達するまで待ってバッチを作る。予測はイベントループを止めないようスレッドで実行する。
+    """
+
+    def __init__(self, predictor, max_batch_size=256, max_wait=0.005, history=10000):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.n_completed = 0
+        # リクエストが処理待ち・処理中だった時間の合計（アイドル時間を除いたスループットの分母）
+        self.active_time = 0.0
+        self._busy_until = 0.0
+
+    async def predict(self, row):
+        """1行を予測キューに入れ、バッチ処理の結果を待つ"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((row, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _predict_rows(self, rows):
+        df = pd.DataFrame(rows)
+        for col in NUMERIC_COLUMNS:
+            if col in df.columns and df[col].dtype == object:
+                df[col] = pd.to_numeric(df[col])
+        return self.predictor.predict(df)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            rows = [row for row, _, _ in batch]
+            try:
+                results = list(await loop.run_in_executor(None, self._predict_rows, rows))
+            except Exception:
+                # 不正な行が含まれる場合は1行ずつ予測し、失敗をその行だけに留める
+                results = []
+                for row in rows:
+                    try:
+                        results.append(float((await loop.run_in_executor(None, self._predict_rows, [row]))[0]))
+                    except Exception as e:
+                        results.append(e)
+
+            now = time.perf_counter()
+            for (_, future, enqueued_at), result in zip(batch, results):
+                # 切断・キャンセルされたクライアントの結果は捨てる（他のクライアントの処理は続ける）
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(float(result))
+                    self.latencies.append(now - enqueued_at)
+            self.batch_sizes.append(len(batch))
+            self.n_completed += len(batch)
+            # バッチの最初のリクエストが届いてから結果を返すまでのうち、前のバッチと重ならない区間を加算
+            first_enqueued = min(enqueued_at for _, _, enqueued_at in batch)
+            self.active_time += max(0.0, now - max(first_enqueued, self._busy_until))
+            self._busy_until = max(self._busy_until, now)
+
+    def stats(self):
+        """レイテンシ（p50/p99, ミリ秒）・スループット・平均バッチサイズ
+
+        スループットはリクエストがあった時間（active_s）あたりの処理件数で、アイドル時間を含まない。
+        """
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'n_completed': self.n_completed,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'active_s': self.active_time,
+            'throughput_rps': self.n_completed / self.active_time if self.active_time > 0 else 0.0,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+        }
+
+
+async def _read_request(reader):
+    """HTTP/1.1のリクエストを読み込み (method, path, body, keep_alive) を返す"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, version = request_line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    body = await reader.readexactly(length) if length else b''
+    keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+    return method, path, body, keep_alive
+
+
+def _response(status, payload, keep_alive):
+    body = json.dumps(payload).encode()
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    headers = [
+        f'HTTP/1.1 {status} {reason}',
+        'Content-Type: application/json',
+        f'Content-Length: {len(body)}',
+        f'Connection: {"keep-alive" if keep_alive else "close"}',
+    ]
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode() + body
+
+
+def make_handler(batcher):
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, body, keep_alive = request
+                if method == 'POST' and path == '/predict':
+                    try:
+                        row = json.loads(body)
+                        status, payload = 200, {'probability': await batcher.predict(row)}
+                    except (ValueError, KeyError) as e:
+                        status, payload = 400, {'error': str(e)}
+                    except Exception as e:
+                        status, payload = 500, {'error': str(e)}
+                elif method == 'GET' and path == '/stats':
+                    status, payload = 200, batcher.stats()
+                else:
+                    status, payload = 404, {'error': f'{method} {path} not found'}
+                writer.write(_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def serve(args):
+    logger = setup_logger(__name__)
+    batcher = MicroBatcher(Predictor(args.artifact_dir), args.max_batch_size, args.max_wait_ms / 1000)
+    batch_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(make_handler(batcher), args.host, args.port)
+    logger.info(f'Serving on http://{args.host}:{args.port} '
+                f'(max_batch_size={args.max_batch_size}, max_wait={args.max_wait_ms} ms)')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+        logger.info(f'Stats: {batcher.stats()}')
+
+
+def main():
+    # 引数の解析
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--artifact-dir', type=str, default='data/output/artifacts')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=256, help='1バッチの最大リクエスト数')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help='バッチを作るまでの最大待ち時間（ミリ秒）')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
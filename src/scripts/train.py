@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import shutil
+from pathlib import Path
+
+from features.loader import load_feature_matrix, make_feature_matrix
+from preprocessing import check_state_outputs
+from run import preprocess_data, preprocess_streaming, train_and_evaluate
+from utils.logger import setup_logger
+
+
+def save_artifacts(config, model, cv_score, artifact_dir, categories=None):
+    """推論に必要なfit済み前処理・カテゴリ列のカテゴリとフォールドモデルを保存
+
+    カテゴリは学習時の行列と同じコードを推論データにも割り当てるために使う（predict.py）。
+    """
+    artifact_dir = Path(artifact_dir)
+    artifact_dir.mkdir(parents=True, exist_ok=True)
+
+    model.save(artifact_dir)
+    shutil.copy(Path('data/output') / 'preprocessing_state.json', artifact_dir / 'preprocessing_state.json')
+    with open(artifact_dir / 'feature_categories.json', 'w') as f:
+        json.dump(categories or {}, f, indent=2)
+    with open(artifact_dir / 'train_summary.json', 'w') as f:
+        json.dump({'config': config, 'cv_score': float(cv_score)}, f, indent=2)
+
+
+def main():
+    # 引数の解析
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/default.json')
+    parser.add_argument('--force', '-f', action='store_true')
+    parser.add_argument('--skip-preprocess', action='store_true', help='前処理をスキップ')
+    parser.add_argument('--streaming', action='store_true', help='CSVをバッチごとに前処理（メモリに載らない入力用）')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='クロスバリデーションの並列フォールド数')
+    parser.add_argument('--artifact-dir', type=str, default='data/output/artifacts', help='学習済みモデルの保存先')
+    args = parser.parse_args()
+
+    # ロガーの設定
+    logger = setup_logger(__name__)
+
+    # 設定の読み込み
+    with open(args.config) as f:
+        config = json.load(f)
+
+    # 前処理
+    if args.streaming and not args.skip_preprocess:
+        data = preprocess_streaming(config)
+    elif not args.skip_preprocess:
+        data = make_feature_matrix(*preprocess_data(config, args.force))
+    else:
+        # アーティファクトにコピーする前処理の状態が、読み込む特徴量ファイルを作ったものか確認
+        check_state_outputs(Path('data/output') / 'preprocessing_state.json', 'data/output')
+        logger.info('Loading preprocessed data...')
+        data = load_feature_matrix(
+            ['titanic_features'], columns=config.get('features'), feature_dir='data/output'
+        )
+
+    # モデルの学習と評価
+    model, _, cv_score = train_and_evaluate(config, data, args.jobs)
+
+    # アーティファクトの保存
+    save_artifacts(config, model, cv_score, args.artifact_dir, data.categories)
+    logger.info(f'Artifacts saved to {args.artifact_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import copy
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import optuna
+import yaml
+
+from features.loader import load_feature_matrix
+from run import get_dataset_cache, get_folds, split_resources, train_fold
+from utils.logger import setup_logger
+
+
+class PruningCallback:
+    """LightGBMの検証スコアをOptunaに報告し、見込みのない試行を学習途中で打ち切る
+
+    ステップはフォールドをまたいで単調増加するよう `(fold - 1) * max_rounds + iteration` とする。
+    """
+
+    def __init__(self, trial, metric, step_offset, period=50):
+        self.trial = trial
+        self.metric = metric
+        self.step_offset = step_offset
+        self.period = period
+
+    def __call__(self, env):
+        iteration = env.iteration + 1
+        if iteration % self.period:
+            return
+        for data_name, eval_name, value, _ in env.evaluation_result_list:
+            if data_name == 'valid' and eval_name == self.metric:
+                step = self.step_offset + iteration
+                self.trial.report(value, step)
+                if self.trial.should_prune():
+                    raise optuna.TrialPruned(f'Trial was pruned at step {step}')
+
+
+def suggest_params(trial):
+    """探索するLightGBMパラメータ"""
+    return {
+        'num_leaves': trial.suggest_int('num_leaves', 8, 256, log=True),
+        'learning_rate': trial.suggest_float('learning_rate', 0.01, 0.2, log=True),
+        'max_depth': trial.suggest_int('max_depth', 3, 12),
+        'min_data_in_leaf': trial.suggest_int('min_data_in_leaf', 5, 100, log=True),
+        'feature_fraction': trial.suggest_float('feature_fraction', 0.5, 1.0),
+        'bagging_fraction': trial.suggest_float('bagging_fraction', 0.5, 1.0),
+        'bagging_freq': trial.suggest_int('bagging_freq', 1, 7),
+        'lambda_l1': trial.suggest_float('lambda_l1', 1e-3, 10.0, log=True),
+        'lambda_l2': trial.suggest_float('lambda_l2', 1e-3, 10.0, log=True),
+    }
+
+
+def create_storage(storage):
+    """RDBのURLはそのまま、それ以外はジャーナルファイルとしてストレージを作成"""
+    if '://' in storage:
+        return storage
+    try:
+        from optuna.storages.journal import JournalFileBackend
+    except ImportError:
+        from optuna.storages import JournalFileStorage as JournalFileBackend
+    return optuna.storages.JournalStorage(JournalFileBackend(storage))
+
+
+def create_sampler_pruner(seed):
+    """スタディのサンプラーと枝刈り（最初の数試行・最初の数百ラウンドは枝刈りしない）
+
+    Optunaはサンプラー・枝刈りの設定をストレージに保存しないため、
+    スタディを読み込む各ワーカーでもこの関数で作り直して渡す。
+    """
+    sampler = optuna.samplers.TPESampler(seed=seed)
+    pruner = optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=100)
+    return sampler, pruner
+
+
+def objective(trial, config, X_train, y_train, folds, dataset, num_threads, report_period):
+    """1試行分のクロスバリデーション（検証データのmetricの平均を最小化）"""
+    model_config = copy.deepcopy(config['model'])
+    model_config['params'].update(suggest_params(trial))
+    model_config['params']['num_threads'] = num_threads
+    metric = model_config['params']['metric']
+    max_rounds = model_config.get('train', {}).get('num_boost_round', 1000)
+
+    scores = []
+    accuracies = []
+    best_iterations = []
+    for fold, train_idx, val_idx in folds:
+        callback = PruningCallback(trial, metric, (fold - 1) * max_rounds, report_period)
+        _, model, _, val_score, _ = train_fold(model_config, fold, train_idx, val_idx,
+                                               X_train, y_train, dataset=dataset, callbacks=[callback])
+        scores.append(model.models[0].best_score['valid'][metric])
+        accuracies.append(val_score)
+        best_iterations.append(model.best_iterations[0])
+
+    trial.set_user_attr('accuracy', float(np.mean(accuracies)))
+    trial.set_user_attr('best_iterations', best_iterations)
+    return float(np.mean(scores))
+
+
+def run_worker(args, config, n_trials, num_threads, seed):
+    """共有ストレージのスタディに対して試行を実行（ワーカープロセスから呼ばれる）
+
+    seedはワーカーごとに変える（同じseedのTPEは並列のワーカーで同じパラメータを提案するため）。
+    """
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+
+    data = load_feature_matrix(['titanic_features'], columns=config.get('features'), feature_dir='data/output')
+    X_train, y_train = data.X_train, data.y_train
+    folds = get_folds(config, y_train, data.train_keys)
+    cache = get_dataset_cache(config)
+    dataset = cache.load(cache.build(X_train, y_train, data.feature_names))
+
+    sampler, pruner = create_sampler_pruner(seed)
+    study = optuna.load_study(study_name=args.study_name, storage=create_storage(args.storage),
+                              sampler=sampler, pruner=pruner)
+    study.optimize(
+        lambda trial: objective(trial, config, X_train, y_train, folds, dataset, num_threads, args.report_period),
+        callbacks=[optuna.study.MaxTrialsCallback(
+            n_trials, states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+        )],
+    )
+
+
+def main():
+    # 引数の解析
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/default.json')
+    parser.add_argument('--experiment', type=str, default='configs/experiment.yaml')
+    parser.add_argument('--n-trials', type=int, default=None, help='試行回数（既定はexperiment.yamlのn_trials）')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='並列に実行する試行数')
+    parser.add_argument('--storage', type=str, default='sqlite:///data/output/optuna.db',
+                        help='RDBのURLまたはジャーナルファイルのパス')
+    parser.add_argument('--study-name', type=str, default=None)
+    parser.add_argument('--report-period', type=int, default=50, help='枝刈り判定を行うラウンド間隔')
+    args = parser.parse_args()
+
+    # ロガーの設定
+    logger = setup_logger(__name__)
+
+    # 設定の読み込み
+    with open(args.config) as f:
+        config = json.load(f)
+    with open(args.experiment) as f:
+        experiment = yaml.safe_load(f)
+    n_trials = args.n_trials or experiment['parameters']['n_trials']
+    args.study_name = args.study_name or experiment['name']
+
+    # スタディの作成
+    seed = experiment['parameters']['random_state']
+    sampler, pruner = create_sampler_pruner(seed)
+    optuna.create_study(
+        study_name=args.study_name,
+        storage=create_storage(args.storage),
+        direction='minimize',
+        sampler=sampler,
+        pruner=pruner,
+        load_if_exists=True,
+    )
+
+    # 試行の実行
+    n_workers, num_threads = split_resources(args.jobs, n_trials)
+    logger.info(f'Running {n_trials} trials with {n_workers} workers ({num_threads} threads each)')
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(run_worker, args, config, n_trials, num_threads, seed + worker)
+                       for worker in range(n_workers)]
+            for future in futures:
+                future.result()
+    else:
+        run_worker(args, config, n_trials, num_threads, seed)
+
+    # 結果の保存
+    study = optuna.load_study(study_name=args.study_name, storage=create_storage(args.storage))
+    n_pruned = len(study.get_trials(states=(optuna.trial.TrialState.PRUNED,)))
+    logger.info(f'Finished {len(study.trials)} trials ({n_pruned} pruned)')
+    logger.info(f'Best value: {study.best_value:.4f}, best params: {study.best_params}')
+
+    best_params_path = Path('data/output') / f'{args.study_name}_best_params.json'
+    with open(best_params_path, 'w') as f:
+        json.dump({'params': study.best_params, **study.best_trial.user_attrs}, f, indent=2)
+    logger.info(f'Best params saved to {best_params_path}')
+
+
+if __name__ == '__main__':
+    main()
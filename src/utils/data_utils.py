@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+
+def iter_csv_batches(path, block_size=1 << 24, column_types=None):
+    """CSVをpyarrowのストリーミングリーダーで読み込み、バッチごとのDataFrameを返す
+
+    列の型は最初のバッチから推論されるため、後半にだけ小数や文字列が現れる列は
+    column_typesで型を指定する。
+
+    Args:
+        path (str or Path): CSVファイルのパス
+        block_size (int, optional): 1バッチあたりの読み込みバイト数. Defaults to 16MB.
+        column_types (dict, optional): 列名→pyarrowの型. Defaults to None.
+
+    Yields:
+        pd.DataFrame: バッチごとのデータ
+    """
+    read_options = pa_csv.ReadOptions(block_size=block_size)
+    convert_options = pa_csv.ConvertOptions(column_types=column_types or {}, strings_can_be_null=True)
+    with pa_csv.open_csv(str(path), read_options=read_options, convert_options=convert_options) as reader:
+        for batch in reader:
+            yield batch.to_pandas()
+
+
+def write_batches(frames, path, file_format='feather', compression=None):
+    """DataFrameのバッチを1つのFeather/Parquetファイルへ逐次書き込む
+
+    スキーマは最初のバッチで決定し、以降のバッチは同じスキーマに揃える
+    （整数列に欠損が現れた場合はnullとして書き込む）。
+
+    Args:
+        frames (iterable): pd.DataFrameのイテラブル
+        path (str or Path): 出力先
+        file_format (str, optional): 'feather' または 'parquet'. Defaults to 'feather'.
+        compression (str, optional): 圧縮方式. Defaults to lz4 (feather) / snappy (parquet).
+
+    Returns:
+        int: 書き込んだ行数
+    """
+    if file_format not in ('feather', 'parquet'):
+        raise ValueError(f'unsupported file format: {file_format}')
+
+    writer = None
+    schema = None
+    n_rows = 0
+    try:
+        for df in frames:
+            if writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                schema = table.schema
+                if file_format == 'feather':
+                    options = pa.ipc.IpcWriteOptions(compression=compression or 'lz4')
+                    writer = pa.ipc.new_file(str(path), schema, options=options)
+                else:
+                    writer = pq.ParquetWriter(str(path), schema, compression=compression or 'snappy')
+            else:
+                table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            writer.write_table(table)
+            n_rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
+
+
+# 列ごとの型の縮小内容を記録するArrowスキーマのメタデータキー
+COMPACT_SCHEMA_KEY = b'compact_schema'
+
+WRITE_MANIFEST = '.write_manifest.json'
+
+
+def _smallest_int(values, nullable):
+    """値が収まる最小幅の整数型（欠損がある場合はpandasのnullable型）"""
+    for dtype in ('int8', 'int16', 'int32', 'int64'):
+        info = np.iinfo(dtype)
+        if values.min() >= info.min and values.max() <= info.max:
+            return dtype.capitalize() if nullable else dtype
+    return None
+
+
+def compact_dtypes(df, float_tolerance=0.0):
+    """列の型を値が表現できる最小の型に縮小する
+
+    - 整数: 最小幅の整数型
+    - 浮動小数点: 値がすべて整数なら整数型（欠損はNaNではなくnullable型のNA）、
+      それ以外はfloat32で表現できる場合のみfloat32（既定は誤差なしのときのみ）
+    - 文字列: category（Arrowでは辞書エンコーディング）
+
+    Args:
+        df (pd.DataFrame): 対象のデータ
+        float_tolerance (float, optional): float32化で許容する相対誤差. Defaults to 0.0.
+
+    Returns:
+        tuple: (縮小後のDataFrame, 変更した列の {列名: {'dtype': 元の型, 'stored': 保存時の型}})
+    """
+    new_types = {}
+    schema = {}
+    for col in df.columns:
+        series = df[col]
+        stored = None
+        if pd.api.types.is_bool_dtype(series):
+            continue
+        if pd.api.types.is_integer_dtype(series):
+            values = series.dropna().to_numpy()
+            if len(values):
+                nullable = isinstance(series.dtype, pd.api.extensions.ExtensionDtype)
+                stored = _smallest_int(values, nullable)
+        elif pd.api.types.is_float_dtype(series):
+            values = series.dropna().to_numpy(dtype=np.float64)
+            if not len(values):
+                continue
+            if np.all(np.mod(values, 1) == 0):
+                stored = _smallest_int(values, nullable=len(values) < len(series))
+            else:
+                as_float32 = values.astype(np.float32).astype(np.float64)
+                if np.all(np.abs(as_float32 - values) <= float_tolerance * np.abs(values)):
+                    stored = 'float32'
+        elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            stored = 'category'
+
+        if stored is not None and stored != str(series.dtype):
+            new_types[col] = stored
+            schema[str(col)] = {'dtype': str(series.dtype), 'stored': stored}
+            if stored == 'float32' and float_tolerance:
+                schema[str(col)]['tolerance'] = float_tolerance
+
+    return (df.astype(new_types) if new_types else df), schema
+
+
+def restore_dtypes(df, schema):
+    """compact_dtypesで縮小した列を元の型に戻す"""
+    types = {col: info['dtype'] for col, info in schema.items() if col in df.columns}
+    return df.astype(types) if types else df
+
+
+def _compact_table(df, float_tolerance):
+    """型を縮小したArrowテーブル（縮小内容をスキーマのメタデータに記録）"""
+    compacted, schema = compact_dtypes(df, float_tolerance)
+    table = pa.Table.from_pandas(compacted, preserve_index=False)
+    metadata = {**(table.schema.metadata or {}), COMPACT_SCHEMA_KEY: json.dumps(schema).encode()}
+    return table.replace_schema_metadata(metadata), schema
+
+
+def write_compact_feather(df, path, compression='lz4', float_tolerance=0.0, chunksize=None):
+    """型を縮小してFeatherで保存し、縮小内容をスキーマのメタデータに記録する
+
+    Args:
+        chunksize (int, optional): 1レコードバッチあたりの行数. Defaults to None.
+
+    Returns:
+        dict: compact_dtypesが返す列ごとの縮小内容
+    """
+    table, schema = _compact_table(df, float_tolerance)
+    feather.write_feather(table, str(path), compression=compression, chunksize=chunksize)
+    return schema
+
+
+def write_compact_parquet(df, path, compression='snappy', float_tolerance=0.0, row_group_size=None):
+    """型を縮小してParquetで保存する（行グループごとに列の統計量が記録される）
+
+    Returns:
+        dict: compact_dtypesが返す列ごとの縮小内容
+    """
+    table, schema = _compact_table(df, float_tolerance)
+    pq.write_table(table, str(path), compression=compression, row_group_size=row_group_size)
+    return schema
+
+
+def read_compact_schema(path):
+    """write_compact_feather/parquetで記録した列ごとの縮小内容を読み込む（記録がなければ空）"""
+    if str(path).endswith('.parquet'):
+        metadata = pq.read_schema(str(path)).metadata or {}
+    else:
+        with pa.memory_map(str(path)) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+    return json.loads(metadata.get(COMPACT_SCHEMA_KEY, b'{}'))
+
+
+def frame_hash(df):
+    """DataFrameの内容（列名・型・値）のハッシュ"""
+    h = hashlib.sha256()
+    h.update(json.dumps([list(map(str, df.columns)), list(map(str, df.dtypes))]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def file_hash(path):
+    """ファイルの内容のハッシュ"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _load_write_manifest(path):
+    manifest_path = Path(path).parent / WRITE_MANIFEST
+    return json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+
+def _file_stamp(path):
+    """ファイルのサイズと更新時刻（別の処理が上書きしたファイルを検出するため）"""
+    stat = Path(path).stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _needs_write(path, content_hash, force):
+    """マニフェストに記録したハッシュ・ファイルのサイズと更新時刻と比べて書き込みが必要か
+
+    ハッシュが一致しても、記録後にファイルが別の内容で上書きされていれば書き直す。
+    """
+    path = Path(path)
+    if force or not path.exists():
+        return True
+    return _load_write_manifest(path).get(path.name) != {'hash': content_hash, **_file_stamp(path)}
+
+
+def _record_write(path, content_hash):
+    """書き込みに成功したファイルのハッシュ・サイズ・更新時刻をマニフェストに記録"""
+    path = Path(path)
+    manifest = _load_write_manifest(path)
+    manifest[path.name] = {'hash': content_hash, **_file_stamp(path)}
+    (path.parent / WRITE_MANIFEST).write_text(json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def write_feather_if_changed(df, path, force=False, compression='lz4'):
+    """内容が前回の書き込みから変わった場合のみ、型を縮小してFeatherで保存
+
+    ハッシュは書き込みが成功してから記録する（失敗したファイルが次回省略されないように）。
+
+    Returns:
+        bool: 書き込んだ場合True
+    """
+    content_hash = frame_hash(df)
+    if not _needs_write(path, content_hash, force):
+        return False
+    write_compact_feather(df, path, compression=compression)
+    _record_write(path, content_hash)
+    return True
+
+
+def write_json_if_changed(obj, path, force=False):
+    """内容が既存ファイルと異なる場合のみJSONで保存
+
+    Returns:
+        bool: 書き込んだ場合True
+    """
+    path = Path(path)
+    text = json.dumps(obj, indent=2)
+    if not force and path.exists() and path.read_text() == text:
+        return False
+    path.write_text(text)
+    return True
+
+
+class StreamingSummary:
+    """数値列の件数・平均・分散と中央値（リザーバサンプリングによる近似）を逐次計算
+
+    サンプル数以下のデータでは中央値は厳密値になる。
+    """
+
+    def __init__(self, sample_size=100_000, seed=42):
+        self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+        self.sample = np.empty(sample_size, dtype=np.float64)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        """欠損を除いた値でサマリを更新"""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        n = len(values)
+        if n == 0:
+            return
+
+        # 平均・分散はバッチごとの統計量を合成（Chanの方法）
+        batch_mean = values.mean()
+        delta = batch_mean - self.mean
+        total = self.count + n
+        self.m2 += ((values - batch_mean) ** 2).sum() + delta ** 2 * self.count * n / total
+        self.mean += delta * n / total
+
+        # リザーバサンプリング
+        n_fill = min(max(self.sample_size - self.count, 0), n)
+        self.sample[self.count:self.count + n_fill] = values[:n_fill]
+        rest = values[n_fill:]
+        if len(rest) and self.sample_size:
+            seen = np.arange(self.count + n_fill, total) + 1
+            slots = self.rng.integers(0, seen)
+            accepted = slots < self.sample_size
+            self.sample[slots[accepted]] = rest[accepted]
+        self.count = total
+
+    def median(self):
+        return float(np.median(self.sample[:min(self.count, self.sample_size)]))
+
+    def std(self):
+        """不偏標準偏差（pandasのstdと同じ定義）"""
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else 0.0
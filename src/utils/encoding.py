@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# 名前から敬称を取り出す正規表現（Arrowのextract_regexは名前付きグループが必要）
+TITLE_PATTERN = r' (?P<title>[A-Za-z]+)\.'
+
+
+def to_arrow_strings(values):
+    """Series・配列・Arrow配列をArrowの文字列配列にする（Arrowバックエンドの列はコピーしない）"""
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    if isinstance(values, pa.Array):
+        if pa.types.is_dictionary(values.type):
+            values = values.dictionary_decode()
+        return values if pa.types.is_string(values.type) else values.cast(pa.string())
+    if isinstance(values, pd.Series) and isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype(object)
+    return pa.array(values, type=pa.string(), from_pandas=True)
+
+
+def extract_title(names):
+    """名前から敬称をArrowの文字列カーネルで取り出す（見つからない場合はnull）"""
+    return pc.struct_field(pc.extract_regex(to_arrow_strings(names), TITLE_PATTERN), [0])
+
+
+class CategoricalEncoder:
+    """文字列のカテゴリを、集約・置換・ラベル化をまとめた1つのルックアップ表で変換する
+
+    置換（replacements）と希少カテゴリの集約（rare）は構築時にラベルの表へ
+    展開しておくため、変換はArrowのindex_inによる1パスで済む。
+    """
+
+    def __init__(self, mapping, replacements=None, rare=None, rare_label='Rare', default=None):
+        """
+        Args:
+            mapping (dict): カテゴリ→ラベル
+            replacements (dict, optional): カテゴリ→置換先のカテゴリ. Defaults to None.
+            rare (list, optional): rare_labelに集約するカテゴリ. Defaults to None.
+            rare_label (str, optional): 希少カテゴリの集約先. Defaults to 'Rare'.
+            default (int, optional): 表にない値・欠損のラベル. Noneなら欠損（NaN）. Defaults to None.
+        """
+        lookup = dict(mapping)
+        for category, replacement in (replacements or {}).items():
+            lookup[category] = mapping[replacement]
+        for category in rare or []:
+            lookup[category] = mapping[rare_label]
+        self.lookup = lookup
+        self.default = default
+        self._keys = pa.array(list(lookup), type=pa.string())
+        # 末尾は表にない値用
+        self._labels = np.array(list(lookup.values()) + [0 if default is None else default])
+
+    @classmethod
+    def for_titles(cls, config):
+        """config（categorical_mappings・title_replacements・rare_titles）から敬称用の表を作る"""
+        return cls(config['categorical_mappings']['Title'], config.get('title_replacements'),
+                   config.get('rare_titles'), default=0)
+
+    def transform(self, values, fill_value=None):
+        """値をラベルのNumPy配列に変換する
+
+        Args:
+            values: 文字列のSeries・配列・Arrow配列
+            fill_value (str, optional): 変換前に欠損を埋める値. Defaults to None.
+
+        Returns:
+            np.ndarray: ラベル（default=Noneで表にない値があればfloatでNaN）
+        """
+        values = to_arrow_strings(values)
+        if fill_value is not None:
+            values = pc.fill_null(values, fill_value)
+        indices = pc.fill_null(pc.index_in(values, value_set=self._keys), len(self._keys)).to_numpy()
+        labels = self._labels[indices]
+        if self.default is None:
+            missing = indices == len(self._keys)
+            if missing.any():
+                labels = labels.astype(np.float64)
+                labels[missing] = np.nan
+        return labels
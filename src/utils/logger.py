@@ -1,29 +1,137 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import atexit
+import json
 import logging
+import os
+import queue
+import re
 import sys
-from pathlib import Path
+from logging.handlers import QueueHandler, QueueListener
 
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
-def setup_logger(name, log_level=logging.INFO):
+# LogRecordの標準属性（JSON出力で追加フィールドと区別する）
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'rate_limit'}
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONで出力する（extraで渡したフィールドも含める）"""
+
+    def format(self, record):
+        payload = {
+            'time': self.formatTime(record),
+            'name': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        payload.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS})
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """似たメッセージ（数値だけが異なるもの）を呼び出し箇所ごとに間引く
+
+    `extra={'rate_limit': 秒}` を付けたメッセージ、またはintervalを指定した場合は
+    INFO以下の全メッセージが対象。間引いた件数は次に出力するメッセージの
+    `suppressed` に入れる。
+    """
+
+    _NUMBER = re.compile(r'[-+]?\d[\d.eE+-]*')
+
+    def __init__(self, interval=None):
+        super().__init__()
+        self.interval = interval
+        self._last = {}
+
+    def filter(self, record):
+        interval = getattr(record, 'rate_limit', None)
+        if interval is None and record.levelno <= logging.INFO:
+            interval = self.interval
+        if not interval:
+            return True
+        key = (record.name, record.pathname, record.lineno, self._NUMBER.sub('#', str(record.msg)))
+        last_time, suppressed = self._last.get(key, (None, 0))
+        if last_time is not None and record.created - last_time < interval:
+            self._last[key] = (last_time, suppressed + 1)
+            return False
+        self._last[key] = (record.created, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class _ProcessSafeQueueHandler(QueueHandler):
+    """キューにレコードを入れるだけのハンドラ
+
+    forkした子プロセスにはQueueListenerのスレッドがないため、子プロセスでは
+    出力先のハンドラへ直接書き込む。
+    """
+
+    def __init__(self, log_queue, target):
+        super().__init__(log_queue)
+        self.target = target
+        self._pid = os.getpid()
+
+    def emit(self, record):
+        if os.getpid() != self._pid:
+            self.target.handle(record)
+        else:
+            super().emit(record)
+
+
+# 出力形式ごとに共有するキューとリスナー
+_listeners = {}
+
+
+def _get_queue_handler(json_format):
+    if json_format not in _listeners:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        handler = _ProcessSafeQueueHandler(log_queue, stream_handler)
+        handler.addFilter(RateLimitFilter())
+        _listeners[json_format] = (listener, handler)
+    return _listeners[json_format][1]
+
+
+def setup_logger(name, log_level=logging.INFO, json_format=None, rate_limit=None):
     """ロガーの設定を行う関数
 
+    整形と標準出力への書き込みはQueueListenerのスレッドで行い、呼び出し側のスレッドは
+    キューに入れるだけにする。同じロガーに対して何度呼んでもハンドラは1つだけ付く。
+
     Args:
         name (str): ロガーの名前
         log_level (int, optional): ログレベル. Defaults to logging.INFO.
+        json_format (bool, optional): JSON形式で出力するか. Defaults to 環境変数LOG_FORMAT=jsonならTrue.
+        rate_limit (float, optional): INFO以下の似たメッセージを出力する最小間隔（秒）. Defaults to None.
 
     Returns:
         logging.Logger: 設定済みのロガー
     """
+    if json_format is None:
+        json_format = os.environ.get('LOG_FORMAT', '').lower() == 'json'
+
     logger = logging.getLogger(name)
     logger.setLevel(log_level)
 
-    # ハンドラの設定
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(log_level)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # ハンドラの設定（設定済みならレベルの変更のみ）
+    handler = _get_queue_handler(json_format)
+    for existing in list(logger.handlers):
+        if isinstance(existing, _ProcessSafeQueueHandler) and existing is not handler:
+            logger.removeHandler(existing)
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+    for existing in [f for f in logger.filters if isinstance(f, RateLimitFilter)]:
+        logger.removeFilter(existing)
+    if rate_limit:
+        logger.addFilter(RateLimitFilter(rate_limit))
 
-    return logger
\ No newline at end of file
+    return logger
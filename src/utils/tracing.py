@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def _max_rss_mb():
+    """プロセスのピークRSS（MB）"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Tracer:
+    """処理区間（スパン）の実行時間・CPU時間・ピークメモリ増分・行数を記録する
+
+    スパンは入れ子にでき、Chrome trace形式（chrome://tracing, Perfetto）で書き出せる。
+    時刻はperf_counter（Linuxではプロセス間で共通の単調時計）を使うため、
+    ワーカープロセスのイベントもmergeで同じタイムラインに並べられる。
+    profileに指定した名前のスパンはcProfile（pyinstrumentを指定した場合はpyinstrument）で
+    プロファイルし、profile_dirに保存する。
+    """
+
+    def __init__(self, profile=(), profiler='cprofile', profile_dir='data/output/profiles'):
+        self.events = []
+        self.profile = set(profile)
+        self.profiler = profiler
+        self.profile_dir = Path(profile_dir)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name, rows=None, **attrs):
+        """区間を計測する。yieldされるdictのrowsを書き換えると処理行数を後から設定できる"""
+        stack = self._stack()
+        info = {'rows': rows, **attrs}
+        stack.append(name)
+        profiler = self._start_profiler(name)
+        rss_before = _max_rss_mb()
+        cpu_start = time.process_time()
+        start = time.perf_counter_ns()
+        try:
+            yield info
+        finally:
+            end = time.perf_counter_ns()
+            cpu = time.process_time() - cpu_start
+            self._stop_profiler(name, profiler)
+            stack.pop()
+            event = {
+                'name': name,
+                'path': '/'.join(stack + [name]),
+                'start_us': start / 1000,
+                'wall_s': (end - start) / 1e9,
+                'cpu_s': cpu,
+                'peak_rss_delta_mb': max(0.0, _max_rss_mb() - rss_before),
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                **{k: v for k, v in info.items() if v is not None},
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def _start_profiler(self, name):
+        if name not in self.profile:
+            return None
+        if self.profiler == 'pyinstrument':
+            import pyinstrument
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, name, profiler):
+        if profiler is None:
+            return
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        stem = f'{name}_{os.getpid()}_{int(time.time() * 1000)}'
+        if self.profiler == 'pyinstrument':
+            profiler.stop()
+            (self.profile_dir / f'{stem}.html').write_text(profiler.output_html())
+        else:
+            profiler.disable()
+            profiler.dump_stats(str(self.profile_dir / f'{stem}.prof'))
+
+    def reset(self):
+        """記録済みのイベントと現在のスパンを破棄する（forkしたワーカープロセスの初期化用）"""
+        with self._lock:
+            self.events = []
+        self._local = threading.local()
+
+    def merge(self, events):
+        """他プロセスで記録したイベントを、呼び出し元の現在のスパンの子として取り込む"""
+        parent = '/'.join(self._stack())
+        with self._lock:
+            for event in events:
+                self.events.append({**event, 'path': f'{parent}/{event["path"]}' if parent else event['path']})
+
+    def write_chrome_trace(self, path):
+        """Chrome trace形式（JSON）で書き出す"""
+        trace_events = []
+        for event in self.events:
+            args = {k: v for k, v in event.items() if k not in ('name', 'start_us', 'wall_s', 'pid', 'tid')}
+            trace_events.append({
+                'name': event['name'],
+                'ph': 'X',
+                'ts': event['start_us'],
+                'dur': event['wall_s'] * 1e6,
+                'pid': event['pid'],
+                'tid': event['tid'],
+                'args': args,
+            })
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        """スパンのパスごとに集計した表（文字列）を返す"""
+        rows = {}
+        for event in self.events:
+            row = rows.setdefault(event['path'], {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'rss_mb': 0.0, 'rows': 0})
+            row['count'] += 1
+            row['wall_s'] += event['wall_s']
+            row['cpu_s'] += event['cpu_s']
+            row['rss_mb'] = max(row['rss_mb'], event['peak_rss_delta_mb'])
+            row['rows'] += event.get('rows') or 0
+
+        lines = [f'{"stage":<40} {"count":>5} {"wall[s]":>9} {"cpu[s]":>9} {"+rss[MB]":>9} {"rows/s":>12}']
+        for path, row in sorted(rows.items()):
+            rows_per_s = f'{row["rows"] / row["wall_s"]:.0f}' if row['rows'] and row['wall_s'] > 0 else '-'
+            lines.append(f'{path:<40} {row["count"]:>5} {row["wall_s"]:>9.3f} {row["cpu_s"]:>9.3f} '
+                         f'{row["rss_mb"]:>9.1f} {rows_per_s:>12}')
+        return '\n'.join(lines)
+
+
+# 既定のトレーサー
+_tracer = Tracer()
+
+
+def get_tracer():
+    return _tracer
+
+
+def configure_tracer(**kwargs):
+    """既定のトレーサーを設定し直す（プロファイル対象のスパン等）"""
+    global _tracer
+    _tracer = Tracer(**kwargs)
+    return _tracer
+
+
+def span(name, rows=None, **attrs):
+    """既定のトレーサーでスパンを計測"""
+    return _tracer.span(name, rows=rows, **attrs)
@@ -1,8 +1,11 @@
 import json
-import wandb
 import os
+import queue
+import threading
+import time
+import uuid
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 
 def load_wandb_config(config_path: str = "configs/wandb.json") -> Dict[str, Any]:
     """wandbの設定を読み込む"""
@@ -21,46 +24,247 @@ def load_wandb_config(config_path: str = "configs/wandb.json") -> Dict[str, Any]
             "config": {}
         }
 
-def init_wandb(config_path: str = "configs/wandb.json") -> wandb.run:
-    """wandbを初期化する"""
-    # APIキーの確認
-    api_key = os.environ.get("WANDB_API_KEY")
-    if not api_key:
-        raise ValueError("WANDB_API_KEYが設定されていません")
-
-    # 設定の読み込み
-    config = load_wandb_config(config_path)
-
-    # wandbの初期化
-    run = wandb.init(
-        project=config["project"],
-        entity=config["entity"],
-        name=config["name"],
-        notes=config["notes"],
-        tags=config["tags"],
-        config=config["config"]
-    )
-    return run
+class WandbBackend:
+    """wandbに送信するバックエンド"""
+
+    def __init__(self, config: Dict[str, Any]):
+        import wandb
+        self.wandb = wandb
+        self.run = wandb.init(
+            project=config["project"],
+            entity=config["entity"],
+            name=config["name"],
+            notes=config["notes"],
+            tags=config["tags"],
+            config=config["config"]
+        )
+        self.run_id = self.run.id
+
+    def log(self, metrics: Dict[str, Any], step: Optional[int] = None):
+        self.wandb.log(metrics, step=step)
+
+    def log_artifact(self, file_path: str, name: str, type: str):
+        artifact = self.wandb.Artifact(name, type=type)
+        artifact.add_file(file_path)
+        self.wandb.log_artifact(artifact)
+
+    def finish(self):
+        self.wandb.finish()
+
+class NullBackend:
+    """何も送信しないバックエンド（テスト・オフライン用）。送信内容はrecordsに残す"""
+
+    def __init__(self, run_id: Optional[str] = None):
+        self.run_id = run_id or uuid.uuid4().hex
+        self.records = []
+
+    def log(self, metrics: Dict[str, Any], step: Optional[int] = None):
+        self.records.append({"kind": "metrics", "metrics": metrics, "step": step})
+
+    def log_artifact(self, file_path: str, name: str, type: str):
+        self.records.append({"kind": "artifact", "file_path": file_path, "name": name, "type": type})
+
+    def finish(self):
+        pass
+
+class TrackingWorker(threading.Thread):
+    """メトリクス・アーティファクトをバックグラウンドでまとめて送信する
+
+    呼び出し側はキューに入れるだけで待たない。同じstepのメトリクスは1回のlogにまとめる。
+    キューが一杯の場合やバックエンドへの送信に失敗した場合は、記録を実行ごとのファイル
+    （buffer_dir/wandb_buffer_{run_id}.jsonl）にJSON Linesで追記し、close時（finish_wandb）に
+    再送する。別の実行の退避記録は再送しない。
+    """
+
+    def __init__(self, backend, max_queue: int = 10000, batch_size: int = 500, flush_interval: float = 1.0,
+                 buffer_dir: str = "data/output"):
+        super().__init__(daemon=True)
+        self.backend = backend
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        run_id = getattr(backend, "run_id", None) or uuid.uuid4().hex
+        self.buffer_path = Path(buffer_dir) / f"wandb_buffer_{run_id}.jsonl"
+        self._buffer_lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def submit(self, record: Dict[str, Any]):
+        """記録をキューに入れる（キューが一杯ならローカルファイルに退避）"""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._buffer([record])
+
+    def _buffer(self, records: List[Dict[str, Any]]):
+        with self._buffer_lock:
+            self.buffer_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.buffer_path, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+    def _collect(self) -> List[Dict[str, Any]]:
+        try:
+            records = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(records) < self.batch_size:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return records
+
+    def _send(self, records: List[Dict[str, Any]]):
+        """記録を送信し、送信できなかった記録を返す"""
+        # 連続する同じstep（指定がある場合）のメトリクスを1つにまとめる
+        merged = []
+        for record in records:
+            if (record["kind"] == "metrics" and record["step"] is not None and merged
+                    and merged[-1]["kind"] == "metrics" and merged[-1]["step"] == record["step"]):
+                merged[-1] = {**merged[-1], "metrics": {**merged[-1]["metrics"], **record["metrics"]}}
+            else:
+                merged.append(record)
+
+        failed = []
+        for i, record in enumerate(merged):
+            try:
+                if record["kind"] == "metrics":
+                    self.backend.log(record["metrics"], step=record["step"])
+                else:
+                    self.backend.log_artifact(record["file_path"], record["name"], record["type"])
+            except Exception as e:
+                print(f"警告: 記録の送信に失敗しました（{self.buffer_path}に退避します）: {str(e)}")
+                failed = merged[i:]
+                break
+        return failed
+
+    def run(self):
+        while not (self._closed.is_set() and self.queue.empty()):
+            records = self._collect()
+            if records:
+                failed = self._send(records)
+                if failed:
+                    self._buffer(failed)
+                for _ in records:
+                    self.queue.task_done()
+
+    def replay_buffer(self):
+        """この実行で退避した記録を再送する
+
+        ファイルはすべての記録の送信が成功してから削除し、送信できなかった分だけを残す。
+        """
+        with self._buffer_lock:
+            if not self.buffer_path.exists():
+                return
+            with open(self.buffer_path) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            failed = self._send(records)
+            if not failed:
+                self.buffer_path.unlink()
+                return
+            tmp_path = self.buffer_path.with_name(self.buffer_path.name + ".tmp")
+            with open(tmp_path, "w") as f:
+                for record in failed:
+                    f.write(json.dumps(record, default=str) + "\n")
+            tmp_path.replace(self.buffer_path)
+
+    def close(self, timeout: Optional[float] = None):
+        """キューに残った記録を送信し終えてからスレッドを終了する"""
+        self._closed.set()
+        self.join(timeout)
+        self.replay_buffer()
+
+# 現在の実行の送信ワーカー
+_worker: Optional[TrackingWorker] = None
+
+def start_tracking(backend, **kwargs) -> TrackingWorker:
+    """バックエンド（WandbBackend・NullBackend等）を指定して送信ワーカーを開始する"""
+    global _worker
+    if _worker is not None:
+        finish_wandb()
+    _worker = TrackingWorker(backend, **kwargs)
+    _worker.start()
+    return _worker
+
+def is_tracking() -> bool:
+    return _worker is not None
+
+def init_wandb(config_path: str = "configs/wandb.json", backend=None, **kwargs):
+    """wandbを初期化し、バックグラウンドの送信ワーカーを開始する
+
+    backendを指定した場合はwandbを使わずにそのバックエンドへ送信する。
+    WANDB_MODE=disabledの場合はNullBackendを使う。
+    """
+    if backend is None:
+        if os.environ.get("WANDB_MODE") == "disabled":
+            backend = NullBackend()
+        else:
+            # APIキーの確認
+            api_key = os.environ.get("WANDB_API_KEY")
+            if not api_key:
+                raise ValueError("WANDB_API_KEYが設定されていません")
+
+            # 設定の読み込み
+            config = load_wandb_config(config_path)
+
+            # wandbの初期化
+            backend = WandbBackend(config)
+    start_tracking(backend, **kwargs)
+    return getattr(backend, "run", None)
 
 def log_metrics(metrics: Dict[str, float], step: Optional[int] = None):
-    """メトリクスをwandbに記録する"""
-    try:
-        wandb.log(metrics, step=step)
-    except Exception as e:
-        print(f"警告: メトリクスの記録に失敗しました: {str(e)}")
+    """メトリクスを送信キューに入れる（送信はバックグラウンドで行う）"""
+    if _worker is None:
+        print("警告: メトリクスの記録に失敗しました: init_wandbが呼ばれていません")
+        return
+    _worker.submit({"kind": "metrics", "metrics": metrics, "step": step, "time": time.time()})
 
 def log_artifact(file_path: str, name: str, type: str):
-    """アーティファクトをwandbに記録する"""
-    try:
-        artifact = wandb.Artifact(name, type=type)
-        artifact.add_file(file_path)
-        wandb.log_artifact(artifact)
-    except Exception as e:
-        print(f"警告: アーティファクトの記録に失敗しました: {str(e)}")
+    """アーティファクトのアップロードを送信キューに入れる"""
+    if _worker is None:
+        print("警告: アーティファクトの記録に失敗しました: init_wandbが呼ばれていません")
+        return
+    _worker.submit({"kind": "artifact", "file_path": str(file_path), "name": name, "type": type})
+
+def lightgbm_callback(prefix: str = "", period: int = 1, step_offset: int = 0):
+    """LightGBMの各イテレーションの評価値を送信キューに流すコールバック
+
+    stepは step_offset + イテレーション（フォールドをまたいで単調増加させる場合はstep_offsetを指定）。
+    同じstepのメトリクスは送信ワーカーで1回のlogにまとめられる。
+    """
+    def _callback(env):
+        iteration = env.iteration + 1
+        if _worker is None or iteration % period:
+            return
+        metrics = {f"{prefix}{data_name}/{eval_name}": value
+                   for data_name, eval_name, value, _ in env.evaluation_result_list}
+        if metrics:
+            log_metrics({**metrics, f"{prefix}iteration": iteration}, step=step_offset + iteration)
+    _callback.order = 30
+    return _callback
+
+def log_evaluation_history(history: Dict[str, Dict[str, List[float]]], prefix: str = "", period: int = 1,
+                           step_offset: int = 0):
+    """lightgbm.record_evaluationで記録した評価値をlightgbm_callbackと同じ形式で送信キューに入れる
+
+    別プロセスで学習したフォールド（コールバックから送信できない）の評価値を後から記録するために使う。
+    """
+    n_iterations = max((len(values) for metrics in history.values() for values in metrics.values()), default=0)
+    for iteration in range(period, n_iterations + 1, period):
+        metrics = {f"{prefix}{data_name}/{eval_name}": values[iteration - 1]
+                   for data_name, eval_metrics in history.items()
+                   for eval_name, values in eval_metrics.items() if len(values) >= iteration}
+        if metrics:
+            log_metrics({**metrics, f"{prefix}iteration": iteration}, step=step_offset + iteration)
 
 def finish_wandb():
-    """wandbの実行を終了する"""
+    """キューに残った記録を送信してからwandbの実行を終了する"""
+    global _worker
+    if _worker is None:
+        return
+    worker, _worker = _worker, None
+    worker.close()
     try:
-        wandb.finish()
+        worker.backend.finish()
     except Exception as e:
-        print(f"警告: wandbの終了に失敗しました: {str(e)}")
\ No newline at end of file
+        print(f"警告: wandbの終了に失敗しました: {str(e)}")